@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# asyncfdb.py
+#
+# Copyright (c) Nicholas J. Radcliffe 2009-2011 and other authors specified
+#               in the AUTHOR
+# Licence terms in LICENCE.
+
+import fdblib
+
+CONCURRENCY = 8         # default maximum number of requests in flight
+
+
+class AsyncFluidDB:
+    """
+    A non-blocking counterpart to fdblib.FluidDB.
+
+    Each of the FluidDB operations below returns immediately with an
+    fdblib.Pending; call its result() method (or use wait()) to get the
+    value the corresponding FluidDB method would have returned.
+    Up to concurrency requests are in flight at once, so issuing many
+    calls before waiting on any of them hides most of the round-trip time.
+
+    The path helpers (abs_tag_path, full_tag_path, path_parts,
+    tag_path_split) are not network operations and run synchronously,
+    using the same code as FluidDB.
+
+    Either wrap an existing FluidDB (db) or pass the usual FluidDB
+    constructor arguments.   All requests share the connection pool
+    of the underlying FluidDB, which is grown if necessary to keep
+    a connection alive for each worker.
+
+    If adaptive is True, the number of requests actually in flight is
+    adjusted (up to concurrency) according to how well the server is
+    keeping up (see fdblib.ConcurrencyController).
+
+    Example:
+
+        adb = AsyncFluidDB()
+        pendings = [adb.tag_object_by_about(about, u'rating', 10)
+                    for about in abouts]
+        errors = adb.wait(pendings)
+    """
+    def __init__(self, db=None, concurrency=CONCURRENCY, credentials=None,
+                 host=None, debug=False, encoding=fdblib.DEFAULT_ENCODING,
+                 unixStylePaths=None, pool=None, adaptive=False):
+        if db is None:
+            db = fdblib.FluidDB(credentials, host, debug, encoding,
+                                unixStylePaths, pool)
+        self.db = db
+        self.concurrency = concurrency
+        self.workers = fdblib.WorkerPool(concurrency)
+        if db.pool.maxSize < concurrency:
+            db.pool.maxSize = concurrency
+        if adaptive and db.controller is None:
+            db.controller = fdblib.ConcurrencyController(concurrency)
+
+    def _submit(self, f, *args, **kwargs):
+        return self.workers.submit(f, *args, **kwargs)
+
+    def wait(self, pendings):
+        """Waits for all the pendings given and returns their results,
+           in order.   Exceptions are re-raised, as by Pending.result()."""
+        return [p.result() for p in pendings]
+
+    def close(self):
+        self.workers.close()
+
+    # Network operations
+
+    def call(self, method, path, body=None, hash=None, **kw):
+        return self._submit(self.db.call, method, path, body, hash, **kw)
+
+    def create_object(self, about=None):
+        return self._submit(self.db.create_object, about)
+
+    def create_namespace(self, path, description=u'',
+                         createParentIfNeeded=True, verbose=False):
+        return self._submit(self.db.create_namespace, path, description,
+                            createParentIfNeeded, verbose)
+
+    def delete_namespace(self, path, recurse=False, force=False,
+                         verbose=False):
+        return self._submit(self.db.delete_namespace, path, recurse, force,
+                            verbose)
+
+    def describe_namespace(self, path):
+        return self._submit(self.db.describe_namespace, path)
+
+    def create_abstract_tag(self, tag, description=None, indexed=True):
+        return self._submit(self.db.create_abstract_tag, tag, description,
+                            indexed)
+
+    def delete_abstract_tag(self, tag):
+        return self._submit(self.db.delete_abstract_tag, tag)
+
+    def tag_object(self, spec, tag, byAbout, value=None, value_type=None,
+                   createAbstractTagIfNeeded=True, inPref=False):
+        return self._submit(self.db.tag_object, spec, tag, byAbout, value,
+                            value_type, createAbstractTagIfNeeded, inPref)
+
+    def tag_object_by_id(self, id, tag, value=None, value_type=None,
+                         createAbstractTagIfNeeded=True, inPref=False):
+        return self.tag_object(id, tag, False, value, value_type,
+                               createAbstractTagIfNeeded, inPref)
+
+    def tag_object_by_about(self, about, tag, value=None, value_type=None,
+                            createAbstractTagIfNeeded=True, inPref=False):
+        return self.tag_object(about, tag, True, value, value_type,
+                               createAbstractTagIfNeeded, inPref)
+
+    def untag_object(self, spec, tag, byAbout, missingConstitutesSuccess=True,
+                     inPref=False):
+        return self._submit(self.db.untag_object, spec, tag, byAbout,
+                            missingConstitutesSuccess, inPref)
+
+    def untag_object_by_id(self, id, tag, missingConstitutesSuccess=True,
+                           inPref=False):
+        return self.untag_object(id, tag, False, missingConstitutesSuccess,
+                                 inPref)
+
+    def untag_object_by_about(self, about, tag, missingConstitutesSuccess=True,
+                              inPref=False):
+        return self.untag_object(about, tag, True, missingConstitutesSuccess,
+                                 inPref)
+
+    def get_tag_value(self, spec, tag, byAbout, inPref=False):
+        return self._submit(self.db.get_tag_value, spec, tag, byAbout, inPref)
+
+    def get_tag_value_by_id(self, id, tag, inPref=False):
+        return self.get_tag_value(id, tag, False, inPref)
+
+    def get_tag_value_by_about(self, about, tag, inPref=False):
+        return self.get_tag_value(about, tag, True, inPref)
+
+    def get_object_tags_by_id(self, id):
+        return self._submit(self.db.get_object_tags_by_id, id)
+
+    def get_object_tags_by_about(self, about):
+        return self._submit(self.db.get_object_tags_by_about, about)
+
+    def query(self, query):
+        return self._submit(self.db.query, query)
+
+    def tag_exists(self, tag):
+        return self._submit(self.db.tag_exists, tag)
+
+    def ns_exists(self, ns):
+        return self._submit(self.db.ns_exists, ns)
+
+    # Path handling (synchronous; shared with FluidDB)
+
+    def abs_tag_path(self, tag, inPref=False, outPref=False):
+        return self.db.abs_tag_path(tag, inPref, outPref)
+
+    def full_tag_path(self, tag):
+        return self.db.full_tag_path(tag)
+
+    def path_parts(self, byAbout, spec, tag=None, inPref=False):
+        return self.db.path_parts(byAbout, spec, tag, inPref)
+
+    def tag_path_split(self, tag):
+        return self.db.tag_path_split(tag)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# audit.py
+#
+# Copyright (c) Nicholas J. Radcliffe 2009-2011 and other authors specified
+#               in the AUTHOR
+# Licence terms in LICENCE.
+#
+# Offline permissions audits (fdb audit) over a snapshot taken with
+# fdb snapshot --with-perms.
+
+import fdblib
+import ls
+import snapshot
+from fdblib import Print
+
+QUESTIONS = {
+    u'world-writable': u'tags and namespaces anyone can write to',
+    u'world-readable': u'tags and namespaces anyone can read',
+    u'readable-by': u'tags and namespaces USER can read',
+    u'writable-by': u'tags and namespaces USER can write to',
+    u'control-differs': (u'tags whose tag and abstract tag control '
+                         u'permissions differ'),
+}
+
+
+class PermsAudit:
+    """
+    The permissions in a snapshot for the tree under root, held
+    column-wise for quick evaluation across many items: for each
+    permission name (read, metadata, ...), a list with an entry for
+    each item, in the order of self.items, of (isOpen, exceptions),
+    with the exceptions as shared frozensets (most items have one of
+    a handful of distinct exception lists), or None for items
+    that don't have that permission (e.g. tag on a namespace).
+
+    Items are tags and namespaces (with a trailing /), as listed by
+    ls; self.missing lists those the snapshot has no permissions for.
+    """
+    def __init__(self, snap, root):
+        self.items = []
+        self.missing = []
+        self.columns = dict((name, []) for name in ls.ALL_NAMES)
+        interned = {}
+        for item in snap.items(root):
+            perms = snap.perms.get(item)
+            if perms is None:
+                self.missing.append(item)
+                continue
+            self.items.append(item)
+            for (name, column) in self.columns.items():
+                p = perms.get(name)
+                if p is None:
+                    column.append(None)
+                else:
+                    exceptions = frozenset(p[1])
+                    exceptions = interned.setdefault(exceptions, exceptions)
+                    column.append((p[0] == u'open', exceptions))
+
+    def matching(self, test):
+        """Returns the items for which test(i) is true,
+           where i is the item's index."""
+        return [item for (i, item) in enumerate(self.items) if test(i)]
+
+    def permits(self, name, i, user=None):
+        """True if the permission name on item i allows user to perform
+           that action, or, if user is None, if its policy is open
+           (as FluidinfoPerm.isOpen).   An open policy allows everyone
+           except the exceptions; a closed one allows only the exceptions."""
+        p = self.columns[name][i]
+        if p is None:
+            return False
+        (isOpen, exceptions) = p
+        if user is None:
+            return isOpen
+        return isOpen != (user in exceptions)
+
+    def world_writable(self):
+        return self.matching(lambda i: any(self.permits(name, i)
+                                           for name in ls.WRITE_NAMES))
+
+    def world_readable(self):
+        return self.matching(lambda i: self.permits(u'read', i))
+
+    def readable_by(self, user):
+        return self.matching(lambda i: self.permits(u'read', i, user))
+
+    def writable_by(self, user):
+        return self.matching(lambda i: any(self.permits(name, i, user)
+                                           for name in ls.WRITE_NAMES))
+
+    def control_differs(self):
+        a = self.columns[u'acontrol']
+        t = self.columns[u'tcontrol']
+        return self.matching(lambda i: t[i] is not None and a[i] != t[i])
+
+
+def execute_audit_command(objs, args, options, credentials):
+    if len(args) == 0 or not args[0] in QUESTIONS:
+        Print(u'Form: audit QUESTION [USER] [namespace]\n\nQuestions:')
+        for q in sorted(QUESTIONS):
+            Print(u'  %-16s %s' % (q, QUESTIONS[q]))
+        return
+    question = args[0]
+    args = args[1:]
+    user = None
+    if question.endswith(u'-by'):
+        if not args:
+            Print(u'Form: audit %s USER [namespace]' % question)
+            return
+        user = args[0]
+        args = args[1:]
+    db = ls.ExtendedFluidDB(host=options.hostname, credentials=credentials,
+                            debug=options.debug,
+                            unixStylePaths=fdblib.path_style(options))
+    snap = snapshot.load_snapshot(db.host)
+    root = (db.abs_tag_path(args[0], inPref=True)[1:] if args
+            else db.credentials.username)
+    if snap is None or not snap.covers(root):
+        Print(u'No snapshot of /%s: use fdb snapshot --with-perms first'
+              % root)
+        return
+    audit = PermsAudit(snap, root)
+    if question == u'world-writable':
+        items = audit.world_writable()
+    elif question == u'world-readable':
+        items = audit.world_readable()
+    elif question == u'readable-by':
+        items = audit.readable_by(user)
+    elif question == u'writable-by':
+        items = audit.writable_by(user)
+    else:
+        items = audit.control_differs()
+    for item in items:
+        Print(item)
+    Print(u'%d of %d items.' % (len(items), len(audit.items)))
+    if audit.missing:
+        Print(u'(%d items have no permissions in the snapshot; '
+              u'use fdb snapshot --with-perms.)' % len(audit.missing))
@@ -10,32 +10,42 @@ import shutil
 import sys
 import types
 from optparse import OptionParser, OptionGroup
-from itertools import chain, imap
+from itertools import chain
 from fdblib import (
     FluidDB,
     O,
     Credentials,
     get_credentials_file,
     get_typed_tag_value,
+    put_values,
+    get_raw_values,
+    delete_values,
     path_style,
     Print,
     toStr,
     uprint,
     version,
+    WorkerPool,
+    ConcurrencyController,
+    set_rate_limit,
     DEFAULT_ENCODING,
     STATUS,
     DADGAD_ID,
     HTTP_TIMEOUT,
+    JOBS,
     SANDBOX_PATH,
     FLUIDDB_PATH,
 )
 import ls
+import snapshot
+import audit
 import flags
 
 
 HTTP_METHODS = ['GET', 'PUT', 'POST', 'DELETE', 'HEAD']
 
-ARGLESS_COMMANDS = ['COUNT', 'TAGS', 'LS', 'PWD', 'PWN', 'WHOAMI']
+ARGLESS_COMMANDS = ['COUNT', 'TAGS', 'LS', 'PWD', 'PWN', 'WHOAMI',
+                    'SNAPSHOT', 'AUDIT']
 
 USAGE = u"""
 
@@ -65,6 +75,14 @@ USAGE = u"""
    fdb whoami              prints username for authenticated user
    fdb pwd / fdb pwn       prints root namespace of authenticated user
    fdb su fdbuser          set fdb to use user credentials for fdbuser
+   fdb rm -R ns            removes the namespace ns and everything in it
+                           (--dry-run lists what would be removed)
+   fdb snapshot [ns]       saves a local copy of the namespace tree under ns
+                           for ls to use for up to an hour (ls --fresh
+                           ignores it; --max-age sets the time in seconds)
+   fdb audit world-writable [ns]
+                           lists items under ns anyone can write to,
+                           from a snapshot (fdb audit for other questions)
 
  Run Tests:
    fdb test                runs all tests
@@ -108,6 +126,14 @@ USAGE_FI = u"""
    fdb whoami              prints username for authenticated user
    fdb pwd / fdb pwn       prints root namespace of authenticated user
    fdb su fdbuser          set fdb to use user credentials for fdbuser
+   fdb rm -R ns            removes the namespace ns and everything in it
+                           (--dry-run lists what would be removed)
+   fdb snapshot [ns]       saves a local copy of the namespace tree under ns
+                           for ls to use for up to an hour (ls --fresh
+                           ignores it; --max-age sets the time in seconds)
+   fdb audit world-writable [ns]
+                           lists items under ns anyone can write to,
+                           from a snapshot (fdb audit for other questions)
 
  Run Tests:
    fdb test            (runs all tests)
@@ -153,26 +179,132 @@ def error_code(n):
     return unicode(n)
 
 
+def fan_out(f, objs, items, db, options):
+    """Calls f(obj, item) for every obj and every item, running up to
+       options.jobs calls at once.
+
+       Returns, for each obj (in order), the list of Pendings for its
+       items (in order), so that output can be produced in the same
+       order as it would be if the calls were made one at a time.
+    """
+    workers = WorkerPool(options.jobs)
+    if db.pool.maxSize < workers.jobs:
+        db.pool.maxSize = workers.jobs
+    if options.adaptive and workers.jobs > 1 and db.controller is None:
+        db.controller = ConcurrencyController(workers.jobs)
+    pendings = [[workers.submit(f, obj, item) for item in items]
+                for obj in objs]
+    workers.close(wait=False)
+    return pendings
+
+
+def report_failures(failures):
+    """Reports the (message, detail) pairs collected while running
+       a command, after all its other output."""
+    for (msg, detail) in failures:
+        warning(msg)
+        warning(detail)
+
+
+def bulk_by_query(objs, f, options):
+    """Applies f(query) once for each distinct query that selected any
+       of objs, unless options.valuesapi is False.   f should act on
+       every object matching the query in a single request and return
+       the HTTP status.
+
+       Returns the set of queries for which f succeeded; objects selected
+       by other queries (and by -a and -i) must be handled one by one,
+       as must those of a query for which f raised an exception.
+    """
+    done = set()
+    if not options.valuesapi:
+        return done
+    for query in unique(getattr(o, 'query', None) for o in objs):
+        if query is None:
+            continue
+        try:
+            status = f(query)
+        except Exception, e:
+            warning(u'Bulk request for %s failed (%s); doing one by one'
+                    % (query, e))
+            continue
+        if status == STATUS.NO_CONTENT:
+            done.add(query)
+    return done
+
+
+def unique(items):
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+
+def apply_to_objects(f, fQuery, objs, items, db, options):
+    """Applies f(obj, item) to every obj and item, except that objects
+       selected by a query are first handled in bulk with fQuery(query)
+       (see bulk_by_query).   Each call of f should return 0 for success
+       or an error code.
+
+       Yields (obj, item, code, err) in order, where code is 0 on success
+       and err is any exception raised by f.
+    """
+    done = bulk_by_query(objs, fQuery, options)
+    loopObjs = [o for o in objs if getattr(o, 'query', None) not in done]
+    loopPendings = iter(fan_out(f, loopObjs, items, db, options))
+    for obj in objs:
+        if getattr(obj, 'query', None) in done:
+            for item in items:
+                yield obj, item, 0, None
+        else:
+            for item, pending in zip(items, loopPendings.next()):
+                err = pending.error()
+                yield obj, item, (None if err else pending.result()), err
+
+
 def execute_tag_command(objs, db, tags, options):
     tags = form_tag_value_pairs(tags)
     actions = {
         u'id': db.tag_object_by_id,
         u'about': db.tag_object_by_about,
     }
-    for obj in objs:
+
+    def tag_one(obj, tag):
+        return actions[obj.mode](obj.specifier, tag.name, tag.value,
+                                 inPref=True)
+
+    def tag_query(query):
+        values = dict((db.abs_tag_path(tag.name, inPref=True)[1:], tag.value)
+                      for tag in tags)
+        return put_values(db, query, values)
+
+    # When tagging what a query selects, create any missing tags first;
+    # otherwise each is created if writing it fails (see tag_object)
+    failures = []
+    if any(getattr(obj, 'query', None) is not None for obj in objs):
+        missing = db.ensure_tags_exist([tag.name for tag in tags],
+                                       inPref=True)
+        failures = [(u'Failed to create tag %s' % path,
+                     u'Error code %s' % error_code(missing[path]))
+                    for path in sorted(missing)]
+        tags = [tag for tag in tags
+                if not db.abs_tag_path(tag.name, inPref=True) in missing]
+    for obj, tag, o, err in apply_to_objects(tag_one, tag_query, objs, tags,
+                                             db, options):
         description = describe_by_mode(obj.specifier, obj.mode)
-        for tag in tags:
-            o = actions[obj.mode](obj.specifier, tag.name, tag.value,
-                                  inPref=True)
-            if o == 0:
-                if options.verbose:
-                    Print(u'Tagged object %s with %s'
-                            % (description,
-                               formatted_tag_value(tag.name, tag.value)))
-            else:
-                warning(u'Failed to tag object %s with %s'
-                        % (description, tag.name))
-                warning(u'Error code %s' % error_code(o))
+        if o == 0:
+            if options.verbose:
+                Print(u'Tagged object %s with %s'
+                        % (description,
+                           formatted_tag_value(tag.name, tag.value)))
+        else:
+            failures.append((u'Failed to tag object %s with %s'
+                             % (description, tag.name),
+                             u'Error %s' % toStr(err) if err
+                             else u'Error code %s' % error_code(o)))
+    # Tagging may have created tags and namespaces that a snapshot lacks
+    snapshot.invalidate(db.host,
+                        created=[db.abs_tag_path(tag.name, inPref=True)[1:]
+                                 for tag in tags])
+    report_failures(failures)
 
 
 def execute_untag_command(objs, db, tags, options):
@@ -180,71 +312,144 @@ def execute_untag_command(objs, db, tags, options):
         'id': db.untag_object_by_id,
         'about': db.untag_object_by_about,
     }
-    for obj in objs:
+
+    def untag_one(obj, tag):
+        return actions[obj.mode](obj.specifier, tag, inPref=True)
+
+    def untag_query(query):
+        return delete_values(db, query, [db.abs_tag_path(tag, inPref=True)[1:]
+                                         for tag in tags])
+
+    failures = []
+    for obj, tag, o, err in apply_to_objects(untag_one, untag_query, objs,
+                                             tags, db, options):
         description = describe_by_mode(obj.specifier, obj.mode)
-        for tag in tags:
-            o = actions[obj.mode](obj.specifier, tag, inPref=True)
-            if o == 0:
-                if options.verbose:
-                    Print('Removed tag %s from object %s\n'
-                          % (tag, description))
+        if o == 0:
+            if options.verbose:
+                Print('Removed tag %s from object %s\n'
+                      % (tag, description))
+        else:
+            failures.append((u'Failed to remove tag %s from object %s'
+                             % (tag, description),
+                             u'Error %s' % toStr(err) if err
+                             else u'Error code %s' % error_code(o)))
+    report_failures(failures)
+
+
+def get_shown_value(obj, tag, db):
+    """Gets the value of tag on obj for the show command,
+       handling the pseudo-tag /id.   Returns (status, value)."""
+    if tag == u'/id':
+        if obj.mode == u'about':
+            o = db.query(u'fluiddb/about = "%s"' % obj.specifier)
+            if type(o) == types.IntType:  # error
+                return o, None
+            elif o == []:
+                return STATUS.NOT_FOUND, None
             else:
-                warning(u'Failed to remove tag %s from object %s'
-                        % (tag, description))
-                warning(u'Error code %s' % error_code(o))
+                return STATUS.OK, o[0]
+        else:
+            return STATUS.OK, obj.specifier
+    elif obj.mode == u'about':
+        return db.get_tag_value_by_about(obj.specifier, tag, inPref=True)
+    else:
+        return db.get_tag_value_by_id(obj.specifier, tag, inPref=True)
+
+
+def bulk_values(objs, paths, db, options):
+    """Fetches the values of the tags with the given paths (full Fluidinfo
+       paths with no leading slash) for every object in objs that was
+       selected by a query, using one GET to /values per query,
+       unless options.valuesapi is False.
+
+       Returns a dictionary mapping (id, path) to (status, value).
+       Opaque (non-primitive) values are not returned by /values,
+       so they, and anything from queries that failed, are left out,
+       and must be fetched individually.
+    """
+    known = {}
+    if not options.valuesapi or not paths:
+        return known
+    for query in unique(getattr(o, 'query', None) for o in objs):
+        if query is None:
+            continue
+        status, H = get_raw_values(db, query, paths)
+        if status != STATUS.OK:
+            continue
+        for obj in objs:
+            if getattr(obj, 'query', None) != query:
+                continue
+            values = H.get(obj.specifier, {})
+            for path in paths:
+                if path not in values:
+                    known[(obj.specifier, path)] = (STATUS.NOT_FOUND, None)
+                elif u'value' in values[path]:
+                    known[(obj.specifier, path)] = (STATUS.OK,
+                                                    values[path][u'value'])
+    return known
+
+
+def print_tag_value(outtag, status, v):
+    if status == STATUS.OK:
+        Print(u'  %s' % formatted_tag_value(outtag, v))
+    elif status == STATUS.NOT_FOUND:
+        Print(u'  %s' % cli_bracket(u'tag %s not present' % outtag))
+    else:
+        Print(cli_bracket(u'error code %s getting tag %s'
+                          % (error_code(status), outtag)))
 
 
 def execute_show_command(objs, db, tags, options):
-    actions = {
-        u'id': db.get_tag_value_by_id,
-        u'about': db.get_tag_value_by_about,
-    }
-    for obj in objs:
+    paths = dict((tag, db.abs_tag_path(tag, inPref=True)[1:])
+                 for tag in tags if tag != u'/id')
+    known = bulk_values(objs, unique(paths.values()), db, options)
+
+    def show_one(obj, tag):
+        key = (obj.specifier, paths.get(tag))
+        if key in known:
+            return known[key]
+        return get_shown_value(obj, tag, db)
+
+    failures = []
+    for obj, pendings in zip(objs, fan_out(show_one, objs, tags, db,
+                                           options)):
         description = describe_by_mode(obj.specifier, obj.mode)
         Print(u'Object %s:' % description)
 
-        for tag in tags:
-            fulltag = db.abs_tag_path(tag, inPref=True)
+        for tag, pending in zip(tags, pendings):
             outtag = db.abs_tag_path(tag, inPref=True, outPref=True)
-            if tag == u'/id':
-                if obj.mode == u'about':
-                    o = db.query(u'fluiddb/about = "%s"' % obj.specifier)
-                    if type(o) == types.IntType:  # error
-                        status, v = o, None
-                    else:
-                        status, v = STATUS.OK, o[0]
-                else:
-                    status, v = STATUS.OK, obj.specifier
-            else:
-                status, v = actions[obj.mode](obj.specifier, tag, inPref=True)
-
-            if status == STATUS.OK:
-                Print(u'  %s' % formatted_tag_value(outtag, v))
-            elif status == STATUS.NOT_FOUND:
-                Print(u'  %s' % cli_bracket(u'tag %s not present' % outtag))
-            else:
-                Print(cli_bracket(u'error code %s getting tag %s'
-                                  % (error_code(status), outtag)))
+            err = pending.error()
+            if err:
+                failures.append((u'Failed to get tag %s from object %s'
+                                 % (outtag, description),
+                                 u'Error %s' % toStr(err)))
+                continue
+            status, v = pending.result()
+            print_tag_value(outtag, status, v)
+    report_failures(failures)
 
 
 def execute_tags_command(objs, db, options):
-    for obj in objs:
+    ids = [db.get_object_id(obj.specifier) if obj.mode == u'about'
+           else obj.specifier for obj in objs]
+    tagLists = [pendings[0].result() for pendings in
+                fan_out(lambda id, item: db.get_object_tags_by_id(id),
+                        ids, [None], db, options)]
+    queryObjs = [O({'mode': u'id', 'specifier': id, 'query': obj.query})
+                 for (obj, id) in zip(objs, ids) if hasattr(obj, 'query')]
+    known = bulk_values(queryObjs, unique(chain(*tagLists)), db, options)
+
+    for obj, id, tags in zip(objs, ids, tagLists):
         description = describe_by_mode(obj.specifier, obj.mode)
         Print(u'Object %s:' % description)
-        id = (db.create_object(obj.specifier).id if obj.mode == u'about'
-              else obj.specifier)
-        for tag in db.get_object_tags_by_id(id):
+        for tag in tags:
             fulltag = u'/%s' % tag
             outtag = u'/%s' % tag if db.unixStyle else tag
-            status, v = db.get_tag_value_by_id(id, fulltag)
-
-            if status == STATUS.OK:
-                Print(u'  %s' % formatted_tag_value(outtag, v))
-            elif status == STATUS.NOT_FOUND:
-                Print(u'  %s' % cli_bracket(u'tag %s not present' % outtag))
+            if (id, tag) in known:
+                status, v = known[(id, tag)]
             else:
-                Print(cli_bracket(u'error code %s getting tag %s'
-                                  % (error_code(status), uttag)))
+                status, v = db.get_tag_value_by_id(id, fulltag)
+            print_tag_value(outtag, status, v)
 
 
 def execute_whoami_command(db):
@@ -406,6 +611,15 @@ def parse_args(args=None):
             help='enables debug mode (more output)')
     general.add_option('-T', '--timeout', type='float', default=HTTP_TIMEOUT,
             metavar='n', help='sets the HTTP timeout to n seconds')
+    general.add_option('-j', '--jobs', type='int', default=JOBS,
+            metavar='n', help=('runs up to n requests at once (for tag, '
+                               'untag and show)'))
+    general.add_option('--adaptive', action='store_true', default=False,
+            help=('with -j, runs fewer requests at once (down to half) '
+                  'while the server is failing or throttling them'))
+    general.add_option('--rate', type='float', default=None,
+            metavar='n', help=('makes at most n requests per second '
+                               '(on average)'))
     general.add_option('-U', '--unixstylepaths', action='store_true',
                        default=False,
             help='Forces unix-style paths for tags and namespaces.')
@@ -419,7 +633,7 @@ def parse_args(args=None):
             help='Report version number.')
     general.add_option('-R', '--recurse', action='store_true',
                        default=False,
-            help='recursive (for ls and rm).')
+            help='recursive (for ls, perms and rm).')
     general.add_option('-l', '--long', action='store_true',
                        default=False,
             help='long listing (for ls).')
@@ -444,6 +658,28 @@ def parse_args(args=None):
     parser.add_option_group(general)
 
     other = OptionGroup(parser, 'Other flags')
+    other.add_option('--no-values-api', action='store_false',
+                     dest='valuesapi', default=True,
+            help=('tag, untag, show and get tags on objects selected with '
+                  '-q one at a time, rather than with a single request to '
+                  '/values'))
+    other.add_option('--perms-cache', action='store_true',
+                     dest='permscache', default=False,
+            help=('remember permissions read by ls and perms between runs '
+                  '(for up to %d seconds)' % ls.PERMS_CACHE_TTL))
+    other.add_option('--fresh', action='store_true', default=False,
+            help=('ignore any snapshot (ls), or re-read all permissions '
+                  '(snapshot --with-perms)'))
+    other.add_option('--max-age', type='float', dest='maxage',
+                     default=snapshot.SNAPSHOT_MAX_AGE,
+            help=('ignore any snapshot taken more than this many seconds '
+                  'ago (ls); default %default'))
+    other.add_option('--with-perms', action='store_true',
+                     dest='snapshotperms', default=False,
+            help='include permissions in the snapshot (for snapshot)')
+    other.add_option('--dry-run', action='store_true', dest='dryrun',
+                     default=False,
+            help='list what rm would remove, without removing anything')
     other.add_option('-s', '--sandbox', action='store_const',
                      dest='hostname', const=SANDBOX_PATH,
             help='use the sandbox at http://sandbox.fluidinfo.com')
@@ -466,12 +702,13 @@ def parse_args(args=None):
 def execute_command_line(action, args, options, parser, user=None, pwd=None):
     credentials = (Credentials(user or options.user[0], pwd)
                    if (user or options.user) else None)
-    if not action == 'ls':
+    if options.rate:
+        set_rate_limit(options.hostname, options.rate)
+    if not action in ('ls', 'snapshot', 'audit'):
         db = FluidDB(host=options.hostname, credentials=credentials,
                      debug=options.debug, unixStylePaths=path_style(options))
-    ids_from_queries = chain(*imap(lambda q: get_ids_or_fail(q, db),
-        options.query))
-    ids = chain(options.id, ids_from_queries)
+    ids_from_queries = [(id, q) for q in options.query
+                                for id in get_ids_or_fail(q, db)]
 
     command_list = [
         'help',
@@ -483,6 +720,9 @@ def execute_command_line(action, args, options, parser, user=None, pwd=None):
         'tags',
         'ls',
         'perms',
+        'rm',
+        'snapshot',
+        'audit',
         'pwd',
         'pwn',
         'test',
@@ -494,7 +734,9 @@ def execute_command_line(action, args, options, parser, user=None, pwd=None):
     ]
 
     objs = [O({'mode': 'about', 'specifier': a}) for a in options.about] + \
-            [O({'mode': 'id', 'specifier': id}) for id in ids]
+            [O({'mode': 'id', 'specifier': id}) for id in options.id] + \
+            [O({'mode': 'id', 'specifier': id, 'query': q})
+             for (id, q) in ids_from_queries]
 
     if action == 'version' or options.version:
         Print('fdb %s' % version())
@@ -535,6 +777,12 @@ def execute_command_line(action, args, options, parser, user=None, pwd=None):
         ls.execute_chmod_command(objs, args, options, credentials)
     elif action == 'perms':
         ls.execute_perms_command(objs, args, options, credentials)
+    elif action == 'rm':
+        ls.execute_rm_command(objs, args, options, credentials)
+    elif action == 'snapshot':
+        ls.execute_snapshot_command(objs, args, options, credentials)
+    elif action == 'audit':
+        audit.execute_audit_command(objs, args, options, credentials)
     elif action in ('pwd', 'pwn', 'whoami'):
         execute_whoami_command(db)
     elif action == 'su':
@@ -24,13 +24,21 @@
 
 import sys, os, time
 import base64
+import gzip
+import shutil
+import tempfile
 import urllib2
 from xml.dom import minidom
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from deliconfig import *
 
 USAGE = 'delicious [-c]      use the -c option to rebuild from the cache'
 
 API_URL='https://api.del.icio.us/v1/posts/all'
+UPDATE_URL='https://api.del.icio.us/v1/posts/update'
 
 def isElement (node):
     return node.nodeType == node.ELEMENT_NODE
@@ -49,6 +57,59 @@ def ParseXMLFile (xmlFile):
 def ParseXMLString (xmlString):
     return minidom.parseString (xmlString)
 
+def IterPostAttributes (source, header=None):
+    """Yields the attributes of each post in a del.icio.us export,
+       as a dictionary, reading source (a filename, or a file-like
+       object such as an open file or the response from urllib2.urlopen)
+       incrementally, and discarding each post once it has been yielded,
+       so that memory use doesn't grow with the number of posts.
+
+       If header is given, it is a dictionary, which is given the tag
+       of the root element (normally posts) as 'tag', and its
+       attributes (such as total) as 'attributes'."""
+    root = None
+    for (event, elem) in ElementTree.iterparse (source, ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                if header is not None:
+                    header['tag'] = root.tag
+                    header['attributes'] = dict (root.attrib)
+        elif elem.tag == 'post':
+            yield dict ((k, unicode (v)) for (k, v) in elem.attrib.items ())
+            root.clear ()
+
+def PostsTotal (source):
+    """Returns the number of posts in the del.icio.us export source,
+       according to the total attribute at its start (or None),
+       without reading any further."""
+    for (event, elem) in ElementTree.iterparse (source, ('start',)):
+        total = elem.get ('total')
+        return int (total) if total and total.isdigit () else None
+
+class Entry:
+    def __init__ (self, url, description, tags, shared, extended):
+        self.url = url
+        self.description = description
+        self.tags = tags
+        self.shared = shared
+        self.extended = extended
+
+    def __str__ (self):
+        return '\n'.join (['%12s: %s' % (k, str (self.__dict__[k]))
+                for k in ['url', 'description', 'tags', 'extended', 'shared']])
+
+def IterEntries (source, header=None):
+    """Yields an Entry for each post in the del.icio.us export source,
+       one at a time (see IterPostAttributes)."""
+    for a in IterPostAttributes (source, header):
+        yield Entry (a.get ('href', u''),
+                     a.get ('description', u'').encode ('ascii', 'ignore'),
+                     (a['tag'].encode ('ascii', 'ignore').split (' ')
+                      if 'tag' in a else []),
+                     a.get ('shared', u'').encode ('ascii', 'ignore') != 'no',
+                     a.get ('extended', u'').encode ('ascii', 'ignore'))
+
 class PageTemplate:
     def __init__ (self, p, phone):
         nCols = p.phonecols if phone else p.cols
@@ -116,12 +177,50 @@ def Usage (exitCode):
     print USAGE
     sys.exit (exitCode)
 
-def GetAllDeliciousEntries (p):
-    request = urllib2.Request(API_URL)
-    credentials64 = base64.encodestring ('%s:%s' % (p.username, p.password))
+def OpenDeliciousURL (url, p):
+    request = urllib2.Request(url)
+    credentials64 = base64.b64encode ('%s:%s' % (p.username, p.password))
     request.add_header ('Authorization', 'Basic %s' % credentials64)
-    f = urllib2.urlopen (request)
-    return f.read ()
+    return urllib2.urlopen (request)
+
+def OpenDeliciousEntries (p):
+    return OpenDeliciousURL (API_URL, p)
+
+def GetLastUpdate (p):
+    """Returns the time of the last change to the user's bookmarks,
+       from posts/update (which is much cheaper than posts/all),
+       or None if it can't be found."""
+    try:
+        f = OpenDeliciousURL (UPDATE_URL, p)
+        try:
+            for (event, elem) in ElementTree.iterparse (f, ('start',)):
+                return elem.get ('time')
+        finally:
+            f.close ()
+    except (IOError, SyntaxError):      # including URLError and ParseError
+        return None
+
+def UpdateMarkerFile (p):
+    """The file recording the last update time (see GetLastUpdate)
+       of the bookmarks in the cache."""
+    return '%s.update' % p.cache
+
+def ReadUpdateMarker (p):
+    try:
+        f = open (UpdateMarkerFile (p))
+        marker = f.read ().strip ()
+        f.close ()
+        return marker or None
+    except IOError:
+        return None
+
+def WriteUpdateMarker (marker, p):
+    f = open (UpdateMarkerFile (p), 'w')
+    f.write (marker + '\n')
+    f.close ()
+
+def GetAllDeliciousEntries (p):
+    return OpenDeliciousEntries (p).read ()
 
 def WriteFileWithBackup (content, filename):
     BackupFile (filename)
@@ -132,67 +231,67 @@ def WriteFileWithBackup (content, filename):
 def WriteFileBackupTimestamp (content, filename, p):
     WriteFileWithBackup (content, filename)
     if p.addDatestampCopy:
-        ts = time.strftime ('%Y%m%d%-%H%M%S')
+        ts = time.strftime ('%Y%m%d-%H%M%S')
         (stem, ext) = os.path.splitext (filename)
         WriteFileWithBackup (content, '%s%s%s' % (stem, ts, ext))
 
+def CopyStreamBackupTimestamp (stream, filename, p):
+    """Like WriteFileBackupTimestamp, but copying the content from
+       the file-like object stream, a block at a time, and compressing
+       the datestamped copy (with gzip).   The content goes to a
+       temporary file first, and only replaces filename (which is
+       then backed up) once all of it has arrived."""
+    dir = os.path.dirname (os.path.abspath (filename))
+    (fd, tmp) = tempfile.mkstemp (dir=dir)
+    try:
+        f = os.fdopen (fd, 'wb')
+        try:
+            shutil.copyfileobj (stream, f)
+        finally:
+            f.close ()
+    except:
+        os.unlink (tmp)
+        raise
+    BackupFile (filename)
+    os.rename (tmp, filename)
+    if p.addDatestampCopy:
+        ts = time.strftime ('%Y%m%d-%H%M%S')
+        (stem, ext) = os.path.splitext (filename)
+        copy = '%s%s%s.gz' % (stem, ts, ext)
+        BackupFile (copy)
+        f = open (filename, 'rb')
+        g = gzip.open (copy, 'wb')
+        shutil.copyfileobj (f, g)
+        g.close ()
+        f.close ()
+
 
-def PrintAllResults (entries):
-    doc = ParseXMLString (entries)
-    print type (doc)
-    posts = FindFirstNamedChild (doc, 'posts')
+def PrintAllResults (source):
     n = 0
-    for node in posts.childNodes:
-	if isElement (node):
-	    for key in node.attributes.keys ():
-	        print '%s : "%s"' % (key,
-		     node.attributes[key].value.encode ('ascii', 'ignore'))
-            print
-	    n += 1
+    for attributes in IterPostAttributes (source):
+        for key in attributes.keys ():
+            print '%s : "%s"' % (key,
+                                 attributes[key].encode ('ascii', 'ignore'))
+        print
+        n += 1
     print '%d Posts' % n
 
-def GetHomeResults (entries, p):
-    doc = ParseXMLString (entries)
+def GetHomeResults (source, p):
     home = {}
-    posts = FindFirstNamedChild (doc, 'posts')
     if not p.caseSensitive:
         tagList = p.tags.lower().split ()
     else:
         tagList = p.tags.split ()
-    for node in posts.childNodes:
-	if isElement (node):
-	    includeEntry = False
-	    description = ''
-	    extended = ''
-	    url = ''
-	    for key in node.attributes.keys ():
-		if key == 'tag':
-		    if p.caseSensitive:
-		        tags = node.attributes[key].value.encode ('ascii', 
-			       'ignore').split (' ')
-		        for t in tagList:
-                            if t in tags:
-                                includeEntry = True
-		    else:
-		        tags = node.attributes[key].value.encode ('ascii', 
-			       'ignore').lower ().split (' ')
-		        for t in tagList:
-                            if t in tags:
-                                includeEntry = True
-		elif key == 'extended':
-		    extended = node.attributes[key].value.encode ('ascii', 
-			   'ignore')
-		elif key == 'description':
-		    description = node.attributes[key].value.encode ('ascii', 
-			   'ignore')
-		elif key == 'href':
-		    url = node.attributes[key].value
-	    if includeEntry:
-	        if extended == '':
-		    extended = description
-		if home.has_key (extended):
-		    print 'Duplicate key :', extended
-		home[extended] = url
+    for entry in IterEntries (source):
+        if p.caseSensitive:
+            tags = entry.tags
+        else:
+            tags = [t.lower () for t in entry.tags]
+        if [t for t in tagList if t in tags]:
+            extended = entry.extended or entry.description
+            if home.has_key (extended):
+                print 'Duplicate key :', extended
+            home[extended] = entry.url
 
     if p.refreshurl and not p.refreshAtBottom:
         home[p.refreshLabel] = p.refreshurl
@@ -303,18 +402,26 @@ def RefreshHomepageFromDelicious (useCache=0, phone=False):
 
     if useCache:
         Report ('Reading entries from cache %s' % p.cache, p)
-        xmlEntries = ReadXML (p.cache)
     else:
+        Report ('Checking del.icio.us for changes', p)
+        marker = GetLastUpdate (p)
+        if (marker and marker == ReadUpdateMarker (p)
+                   and os.path.exists (p.cache)):
+            Report ('No changes since %s; home page is up to date.' % marker,
+                    p)
+            Report ('Completed OK.', p)
+            return
         Report ('Reading entries from del.icio.us', p)
-        xmlEntries = GetAllDeliciousEntries (p)
         Report  ('Writing cache %s' % p.cache, p)
-        WriteFileBackupTimestamp (xmlEntries, p.cache, p)
+        CopyStreamBackupTimestamp (OpenDeliciousEntries (p), p.cache, p)
 
-    home = GetHomeResults (xmlEntries, p)
+    home = GetHomeResults (p.cache, p)
     homepage = p.phonepage if phone else p.homepage
     Report ('Building home page %s' % homepage, p)
     page = BuildPage (home, h, p, phone)
     WriteFileBackupTimestamp (page, homepage, p)
+    if not useCache and marker:
+        WriteUpdateMarker (marker, p)   # only once the page is up to date
     Report ('Home page built and backed up', p)
     Report ('Completed OK.', p)
 
@@ -6,98 +6,340 @@
 #
 # See LICENSE for license.
 #
-import types, sys
+import types, sys, os, time
+import hashlib
+import json
+from collections import deque
 import fdb
 #import fdbdummy as fdb
 from delicious import *
 try:
     from abouttag.uri import URI
 except ImportError:
-    print 'You need the abouttag library on your PYTHONPATH.'
-    print 'It is available from https://github.com/njr0/abouttag'
-    raise
-
-
-class Entry:
-    def __init__ (self, url, description, tags, shared, extended):
-        self.url = url
-        self.description = description
-        self.tags = tags
-        self.shared = shared
-        self.extended = extended
-
-    def __str__ (self):
-        return '\n'.join (['%12s: %s' % (k, str (self.__dict__[k]))
-                for k in ['url', 'description', 'tags', 'extended', 'shared']])
-
-def Process (entries, p):
-    doc = ParseXMLString (entries)
-    entries = []
-    posts = FindFirstNamedChild (doc, 'posts')
-    for node in posts.childNodes:
-        description = ''
-        extended = ''
-        url = ''
-        tags = []
-        shared = True
-	if isElement (node):
-	    for key in node.attributes.keys ():
-		if key == 'shared':
-                    shared = node.attributes[key].value.encode ('ascii', 
-			       'ignore')  != "no"
-		if key == 'tag':
-                    tags = node.attributes[key].value.encode ('ascii', 
-			       'ignore').split (' ')
-		elif key == 'extended':
-		    extended = node.attributes[key].value.encode ('ascii', 
-			   'ignore')
-		elif key == 'description':
-		    description = node.attributes[key].value.encode ('ascii', 
-			   'ignore')
-		elif key == 'href':
-		    url = node.attributes[key].value
-            entries.append (Entry (url, description, tags, shared, extended))
-    return entries        
+    URI = None          # needed only to import new bookmarks
+
+
+def Process (source, p, header=None):
+    """Returns an iterator over the Entry for each post in the del.icio.us
+       export source (a filename or file-like object), which is read
+       incrementally (see IterEntries)."""
+    return IterEntries (source, header)
 
 def GetEntryList (p):
-    xmlEntries = ReadXML (p.cache)
-    entries = Process (xmlEntries, p)
-    return entries 
+    return Process (p.cache, p)
 
+JOBS = 16               # entries imported at once
+WINDOW = 256            # entries read ahead of the oldest unfinished one
+MANIFEST_SYNC = 100     # records written between syncs of the manifest
+REPORT_INTERVAL = 10.0  # seconds between progress reports
+MAX_REMOVED = 0.1       # fraction of bookmarks removed without --force
 
-if __name__ == '__main__':
-    startAt = 0 if len(sys.argv) < 2 else int(sys.argv[1])
-    p = GetCredentials()
-    entries = GetEntryList(p)
-    nTotal = len(entries)
-    entries = [e for e in entries if e.shared == True]
-    nShared = len(entries)
-    print 'Removed %d private entries' % (nTotal - nShared)
-
-    db = fdb.FluidDB()
-    nURLs = nTags = 0
-    tagsUsed = set()
-    for i, entry in enumerate(entries[startAt:]):
-        if entry.url:
-            uri = URI(unicode(entry.url)).encode('UTF-8')
-            print '%4d: Tagging %s as %s:' % (i + startAt, entry.url, uri)
-            nURLs += 1
-        else:
-            print 'Blank URL'
-        o = db.create_object(uri)
-        if type (o) == types.IntType:   # error
-            print 'Error occurred, code %d' % o
+
+def UrlKey (url):
+    return hashlib.md5 (url.encode ('UTF-8')).hexdigest ()
+
+def EntryTags (entry):
+    return sorted (set (t for t in entry.tags if t))   # no empty tags
+
+
+class Manifest:
+    """
+    A record of what has been imported: for each bookmark, keyed
+    by a hash of its URL (see UrlKey), the ID of its object and the
+    (sorted) tags it was given, so that later imports need only send
+    what has changed, and can untag bookmarks that have gone.
+
+    The file is a log, with a line of JSON, [key, id, tags], appended
+    for each bookmark as it's imported, or [key] when one is removed,
+    so that an import that stops part way through, for whatever reason,
+    carries on from where it stopped when run again.   Each record is
+    flushed as it's written, and the file is synced to disk every
+    MANIFEST_SYNC records; compact() rewrites it with just the latest
+    record for each bookmark.
+    """
+    def __init__ (self, filename):
+        self.filename = filename
+        self.entries = {}       # key -> (id, tags)
+        self.f = None
+        self.nUnsynced = 0
+
+    def load (self):
+        """Reads the manifest, returning the number of bookmarks in it.
+           A partial last line (left by a crash) is ignored."""
+        if os.path.exists (self.filename):
+            f = open (self.filename, 'rb')
+            for line in f:
+                try:
+                    r = json.loads (line)
+                except ValueError:
+                    continue
+                if len (r) == 3:
+                    self.entries[r[0]] = (r[1], r[2])
+                else:
+                    self.entries.pop (r[0], None)
+            f.close ()
+        return len (self.entries)
+
+    def get (self, key):
+        """Returns (id, tags) for the bookmark with key, or None."""
+        return self.entries.get (key)
+
+    def keys (self):
+        return self.entries.keys ()
+
+    def _write (self, r):
+        if self.f is None:
+            self.f = open (self.filename, 'ab')
+        self.f.write (json.dumps (r, separators=(',', ':')) + '\n')
+        self.f.flush ()
+        self.nUnsynced += 1
+        if self.nUnsynced >= MANIFEST_SYNC:
+            self.sync ()
+
+    def record (self, key, id, tags):
+        self.entries[key] = (id, tags)
+        self._write ([key, id, tags])
+
+    def forget (self, key):
+        del self.entries[key]
+        self._write ([key])
+
+    def sync (self):
+        if self.f and self.nUnsynced:
+            os.fsync (self.f.fileno ())
+            self.nUnsynced = 0
+
+    def compact (self):
+        self.close ()
+        tmp = self.filename + '.tmp'
+        f = open (tmp, 'wb')
+        for (key, (id, tags)) in self.entries.iteritems ():
+            f.write (json.dumps ([key, id, tags], separators=(',', ':'))
+                     + '\n')
+        f.flush ()
+        os.fsync (f.fileno ())
+        f.close ()
+        os.rename (tmp, self.filename)
+
+    def close (self):
+        if self.f:
+            self.sync ()
+            self.f.close ()
+            self.f = None
+
+
+def ImportEntry (db, entry, old=None, createTags=True):
+    """Brings the object for entry's URL up to date: if old, the
+       (id, tags) it was last imported with, is None, creates (or finds)
+       the object, and tags it with each of entry's tags; otherwise tags
+       it with just the new tags and untags those that have gone.
+       Missing tags are created if createTags is True.
+
+       Returns the object's ID (or None if the object couldn't be
+       created or found), and the list of (tag, error) pairs for
+       the tags that failed."""
+    tags = EntryTags (entry)
+    if old is None:
+        uri = URI (unicode (entry.url)).encode ('UTF-8')
+        id = db.get_object_id (uri)
+        if type (id) == types.IntType:
+            return (None, [])
+        (add, remove) = (tags, [])
+    else:
+        id = old[0]
+        (add, remove) = ([t for t in tags if not t in old[1]],
+                         [t for t in old[1] if not t in tags])
+    failures = []
+    for tag in add:
+        error = db.tag_object_by_id (id, tag,
+                                     createAbstractTagIfNeeded=createTags)
+        if error:
+            failures.append ((tag, error))
+    for tag in remove:
+        error = db.untag_object_by_id (id, tag)
+        if error:
+            failures.append ((tag, error))
+    return (id, failures)
+
+def RemoveEntry (db, (id, tags)):
+    """Untags the object for a bookmark that has gone (or become private).
+       Returns the list of (tag, error) pairs for the tags that failed."""
+    failures = []
+    for tag in tags:
+        error = db.untag_object_by_id (id, tag)
+        if error:
+            failures.append ((tag, error))
+    return failures
+
+def FormatSeconds (s):
+    return '%d:%02d:%02d' % (s / 3600, s / 60 % 60, s % 60)
+
+def Import (db, source, manifest, jobs=JOBS, window=WINDOW,
+            reportInterval=REPORT_INTERVAL, force=False):
+    """
+    Brings FluidDB, through db, up to date with the shared entries
+    in the del.icio.us export source, according to the manifest of
+    what has been imported before: new bookmarks are imported, those
+    whose tags have changed are tagged and untagged accordingly, and
+    bookmarks no longer in the export (or no longer shared) have their
+    tags removed.   Unchanged bookmarks cost nothing.   The manifest
+    is updated as each bookmark is done, and compacted at the end.
+
+    Since a bad export (an error from del.icio.us, or a truncated
+    download) would otherwise look like a mass deletion, bookmarks
+    are only removed if the export is a posts element with as many
+    posts as its total says, and, unless force is True, no more than
+    MAX_REMOVED of the bookmarks in the manifest are to be removed.
+
+    If source is a filename, the export is first read through to
+    collect the new tags needed, so that they can all be created at
+    once (see FluidDB.ensure_tags_exist), rather than as each is
+    first used.
+
+    The export is read incrementally; up to jobs entries are imported
+    at once, with no more than window read ahead of the oldest one
+    not yet finished, and progress (throughput and, if the export says
+    how many posts it has, the estimated time left) is printed every
+    reportInterval seconds.
+
+    Returns a dictionary of counts.
+    """
+    counts = dict ((k, 0) for k in ('posts', 'private', 'blank', 'new',
+                                    'changed', 'unchanged', 'removed',
+                                    'failed'))
+    total = None
+    createTags = True
+    if isinstance (source, basestring):     # so it can be read twice
+        total = PostsTotal (source)
+        tags = set ()
+        for entry in Process (source, None):
+            if entry.shared == True and entry.url:
+                old = manifest.get (UrlKey (entry.url))
+                tags.update (t for t in EntryTags (entry)
+                             if old is None or not t in old[1])
+        print 'Checking %d tags exist' % len (tags)
+        missing = db.ensure_tags_exist (tags, jobs=jobs)
+        for tag in sorted (missing):
+            print 'Could not create tag %s (%s)' % (tag, missing[tag])
+        createTags = False
+    workers = fdb.WorkerPool (jobs)
+    if db.pool.maxSize < workers.jobs:
+        db.pool.maxSize = workers.jobs
+    start = lastReport = time.time ()
+    inFlight = deque ()
+    seen = set ()
+    header = {}
+    failed = []             # URLs of the bookmarks that failed
+
+    def finish ((key, entry, kind, pending)):
+        error = pending.error ()
+        (id, failures) = (None, []) if error else pending.result ()
+        if error:
+            print 'Failed to import %s (%s)' % (entry.url, error)
+        elif id is None:
+            print 'Could not create object for %s' % entry.url
+        elif failures:
+            print 'Failed to update %s with %s' % (entry.url,
+                    ', '.join ('%s (%s)' % (t, e) for (t, e) in failures))
         else:
-            for tag in [t for t in entry.tags if t]: # no empty tags
-                error = db.tag_object_by_id (o.id, tag)
-                print '   %s' % tag,
-                sys.stdout.flush ()
-                if error == 0:
-                    nTags += 1
-                    tagsUsed.add (tag)
+            counts[kind] += 1
+            manifest.record (key, id, EntryTags (entry))
+            return
+        counts['failed'] += 1
+        failed.append (entry.url)
+
+    def report ():
+        elapsed = time.time () - start
+        rate = counts['posts'] / elapsed if elapsed else 0.0
+        eta = ('; ETA %s' % FormatSeconds ((total - counts['posts']) / rate)
+               if total and rate and total >= counts['posts'] else '')
+        print ('%d%s posts read (%.1f/s); %d new, %d changed, %d unchanged, '
+               '%d failed%s'
+               % (counts['posts'], ' of %d' % total if total else '', rate,
+                  counts['new'], counts['changed'], counts['unchanged'],
+                  counts['failed'], eta))
+        sys.stdout.flush ()
+
+    try:
+        try:
+            for entry in Process (source, None, header):
+                counts['posts'] += 1
+                if entry.shared != True:
+                    counts['private'] += 1
+                elif not entry.url:
+                    counts['blank'] += 1
                 else:
-                    print '\n ---> FAILURE!'
-            print
-    print ('%d URLs tagged in FluidDB, with a total of %d tags (%d distinct)'
-                % (nURLs, nTags, len (tagsUsed)))
-    print '\nTags were: %s' % (' '.join ([tag for tag in tagsUsed]))
+                    key = UrlKey (entry.url)
+                    seen.add (key)
+                    old = manifest.get (key)
+                    if old and old[1] == EntryTags (entry):
+                        counts['unchanged'] += 1
+                    else:
+                        kind = 'changed' if old else 'new'
+                        pending = workers.submit (ImportEntry, db, entry,
+                                                  old, createTags)
+                        inFlight.append ((key, entry, kind, pending))
+                while inFlight and (len (inFlight) >= window
+                                    or inFlight[0][3].done ()):
+                    finish (inFlight.popleft ())
+                if time.time () - lastReport >= reportInterval:
+                    report ()
+                    lastReport = time.time ()
+        finally:
+            # record whatever was done, even if reading the export failed
+            while inFlight:
+                finish (inFlight.popleft ())
+        gone = [key for key in manifest.keys () if not key in seen]
+        expected = header.get ('attributes', {}).get ('total')
+        if gone and (header.get ('tag') != 'posts'
+                     or expected != str (counts['posts'])):
+            print ('Not removing %d bookmarks: the export is incomplete '
+                   '(%d posts read, but it should have %s)'
+                   % (len (gone), counts['posts'], expected))
+            gone = []
+        elif len (gone) > MAX_REMOVED * len (manifest.keys ()) and not force:
+            print ('Not removing %d of the %d bookmarks imported before '
+                   '(use --force to remove them)'
+                   % (len (gone), len (manifest.keys ())))
+            gone = []
+        pendings = [workers.submit (RemoveEntry, db, manifest.get (key))
+                    for key in gone]
+        for (key, pending) in zip (gone, pendings):
+            error = pending.error ()
+            failures = [] if error else pending.result ()
+            if error or failures:
+                counts['failed'] += 1
+                print 'Failed to untag %s with %s' % (manifest.get (key)[0],
+                        error or ', '.join ('%s (%s)' % (t, e)
+                                            for (t, e) in failures))
+            else:
+                counts['removed'] += 1
+                manifest.forget (key)
+        manifest.compact ()
+    finally:
+        workers.close ()
+        manifest.close ()
+    report ()
+    if failed:
+        print 'These bookmarks failed, and will be tried again next time:'
+        for url in failed:
+            print '    %s' % url
+    return counts
+
+
+if __name__ == '__main__':
+    if URI is None:
+        print 'You need the abouttag library on your PYTHONPATH.'
+        print 'It is available from https://github.com/njr0/abouttag'
+        sys.exit (1)
+    p = GetCredentials ()
+    manifest = Manifest (p.cache + '.manifest')
+    if manifest.load ():
+        print ('%d bookmarks imported before; sending only changes '
+               '(delete %s to import everything again)'
+               % (len (manifest.keys ()), manifest.filename))
+    counts = Import (fdb.FluidDB (), p.cache, manifest,
+                     force='--force' in sys.argv[1:])
+    print ('%(new)d new and %(changed)d changed bookmarks imported, '
+           '%(removed)d removed; %(unchanged)d unchanged, %(failed)d failed, '
+           '%(private)d private and %(blank)d blank skipped' % counts)
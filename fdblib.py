@@ -9,12 +9,23 @@
 __version__ = u'2.16'
 VERSION = __version__
 
+import atexit
 import codecs
+import httplib
 import os
+import random
+import tempfile
+import Queue
 import re
+import socket
 import sys
+import threading
+import time
 import types
 import urllib
+import urlparse
+import weakref
+from collections import OrderedDict
 from functools import wraps
 from httplib2 import Http
 
@@ -85,8 +96,10 @@ class STATUS:
     OK = 200
     CREATED = 201
     NO_CONTENT = 204
+    NOT_MODIFIED = 304
     INTERNAL_SERVER_ERROR = 500
     NOT_FOUND = 404
+    PRECONDITION_FAILED = 412
     UNAUTHORIZED = 401
     BAD_REQUEST= 400
 
@@ -102,6 +115,26 @@ CRED_FILE_VAR = 'FDB_CREDENTIALS_FILE'
 WIN_CRED_FILE = 'c:\\fdb\\credentials.txt'
 
 HTTP_TIMEOUT = 300.123456       # unlikey the user will choose this
+POOL_SIZE = 4                   # idle connections kept per host
+POOL_IDLE_TIMEOUT = 60.0        # seconds before an idle connection is dropped
+JOBS = 1                        # default number of requests in flight at once
+RETRY_ATTEMPTS = 4              # attempts at a request before giving up
+RETRY_BASE = 0.5                # seconds before the first retry...
+RETRY_CAP = 30.0                # ...doubling each time up to this
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CONGESTION_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = (u'GET', u'HEAD', u'PUT', u'DELETE')
+
+CACHE_DIR = u'.fdbcache'        # in the user's home directory
+ID_CACHE_SIZE = 100000          # about -> ID mappings kept per host
+ID_WARM_BATCH = 50              # about values per query when warming
+VALUES_TAGS = 20                # tags per GET /values, to bound URL length
+ENSURE_JOBS = 8                 # requests at once when ensuring tags exist
+VALIDATOR_ENTRIES = 1000        # URLs whose ETag/Last-Modified are kept
+VALIDATOR_BYTES = 50000000      # ...and their bodies, for 304 responses
+VALUE_CACHE_TTL = 60.0          # seconds a cached tag value is trusted
+VALUE_CACHE_ENTRIES = 10000
+VALUE_CACHE_BYTES = 10000000
 PRIMITIVE_CONTENT_TYPE = u'application/vnd.fluiddb.value+json'
 
 INTEGER_RE = re.compile(ur'^[+\-]{0,1}[0-9]+$')
@@ -125,13 +158,22 @@ class SaveOut:
     def clear(self):
         self.buffer = []
 
+    def flush(self):
+        pass
+
 class UnicodeOut:
     def __init__(self, std):
         self.std = std
 
     def write(self, msg):
         self.std.write((msg.encode('UTF-8') if type(msg) == unicode else msg))
-            
+
+    def flush(self):
+        self.std.flush()
+
+    def isatty(self):
+        return self.std.isatty()
+
 
 def quote_u_u(s):
     """Quote a unicode string s using %-encoding.
@@ -164,17 +206,24 @@ def quote_u_8(s):
 
 
 def urlencode_hash_u_8(hash):
-    """Applies urllib.urlencode to a hash that may contain unicode values."""
+    """Applies urllib.urlencode to a hash that may contain unicode values,
+       or lists (or tuples) of them, which are sent as repeated
+       parameters."""
     h8 = {}
     for key in hash:
         v = hash[key]
-        h8[key] = v.encode('UTF-8') if type(v) == unicode else v
+        if type(v) in (list, tuple):
+            h8[key] = [e.encode('UTF-8') if type(e) == unicode else e
+                       for e in v]
+        else:
+            h8[key] = v.encode('UTF-8') if type(v) == unicode else v
     return urllib.urlencode(h8, True)
 
 
 def id(about, host):
-    # this might turn into a cache that gets dumped to file and
-    # supports more than two fixed hosts in time.
+    cached = about_id_cache(host).get(about)
+    if cached:
+        return cached
     cache = IDS_MAIN if host == FLUIDDB_PATH else IDS_SAND
     return cache[about]
 
@@ -182,13 +231,297 @@ def id(about, host):
 def by_about(f):
     @wraps(f)
     def wrapper(self, about, *args, **kwargs):
-        o = self.create_object(about=about)
-        if type(o) == types.IntType:   # error code
-            return o, None
-        return f(self, o.id, *args, **kwargs)
+        id = self.get_object_id(about)
+        if type(id) == types.IntType:   # error code
+            return id, None
+        return f(self, id, *args, **kwargs)
     return wrapper
 
 
+def get_cache_dir():
+    return os.path.join(os.path.expanduser('~'), CACHE_DIR)
+
+
+def save_cache_file(filename, read, merge):
+    """Saves a cache kept as JSON in filename, which other processes
+       may also be saving: merge(read()) is called with what's in the
+       file now, and returns what to write instead.   The file is
+       replaced in one step, so readers never see half of it.
+
+       Returns True if the file was written.   Failures are ignored,
+       since it's only a cache."""
+    dir = os.path.dirname(filename)
+    try:
+        data = merge(read())
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd, tmp = tempfile.mkstemp(dir=dir)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class AboutIDCache:
+    """
+    Remembers the object ID for each about value on one host.
+    Since an about value maps to the same object forever, entries
+    never go stale.
+
+    Up to size mappings are kept in memory, least recently used
+    first out.   If filename is given, the cache is loaded from there
+    when first used and save() writes it back (merging with anything
+    other processes have saved in the meantime); that normally happens
+    automatically when the program exits.
+    """
+    def __init__(self, host, filename=None, size=ID_CACHE_SIZE):
+        self.host = host
+        self.filename = filename
+        self.size = size
+        self.ids = OrderedDict()
+        self.loaded = filename is None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        for (about, id) in self._read():
+            self._put(about, id)
+
+    def _read(self):
+        try:
+            f = open(self.filename)
+            try:
+                pairs = json.load(f)
+            finally:
+                f.close()
+            return [(about, id) for (about, id) in pairs]
+        except (IOError, OSError, ValueError, TypeError):
+            return []
+
+    def _put(self, about, id):
+        self.ids.pop(about, None)
+        self.ids[about] = id
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def get(self, about):
+        with self.lock:
+            self._load()
+            id = self.ids.pop(about, None)
+            if id is not None:
+                self.ids[about] = id
+            return id
+
+    def put(self, about, id):
+        with self.lock:
+            self._load()
+            if self.ids.get(about) != id:
+                self.dirty = True
+            self._put(about, id)
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return len(self.ids)
+
+    def save(self):
+        """Writes the cache to its file, if it has one and has changed."""
+        with self.lock:
+            if not (self.filename and self.dirty):
+                return
+
+            def merge(pairs):
+                ids = OrderedDict(pairs)
+                for about in self.ids:
+                    ids.pop(about, None)
+                    ids[about] = self.ids[about]
+                return ids.items()[-self.size:]
+
+            if save_cache_file(self.filename, self._read, merge):
+                self.dirty = False
+
+
+class TagValueCache:
+    """
+    An optional cache for FluidDB.get_tag_value, enabled by setting
+    db.valueCache to an instance of this class.   Entries are keyed on
+    (host, object ID, absolute tag path) and hold the (status, value)
+    pair returned, for found and not-found tags.
+
+    Entries expire ttl seconds after they are read from Fluidinfo,
+    to limit staleness from changes made elsewhere; changes made
+    through the FluidDB instance itself update or invalidate the
+    affected entries.   At most maxEntries entries and (roughly)
+    maxBytes bytes of values are kept, least recently used first out.
+    """
+    def __init__(self, ttl=VALUE_CACHE_TTL, maxEntries=VALUE_CACHE_ENTRIES,
+                 maxBytes=VALUE_CACHE_BYTES):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()    # key -> (expiry, result, nBytes)
+        self.nBytes = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.nBytes -= entry[2]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.nBytes -= entry[2]
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, result, nBytes=0):
+        with self.lock:
+            self._remove(key)
+            if nBytes > self.maxBytes:
+                return
+            self.entries[key] = (time.time() + self.ttl, result, nBytes)
+            self.nBytes += nBytes
+            while (len(self.entries) > self.maxEntries
+                   or self.nBytes > self.maxBytes):
+                key, entry = self.entries.popitem(last=False)
+                self.nBytes -= entry[2]
+
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate_tag(self, host, tag):
+        """Removes entries for the tag (absolute path) on every object."""
+        with self.lock:
+            for key in [k for k in self.entries
+                        if k[0] == host and k[2] == tag]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ValidatorStore:
+    """
+    Remembers, for recently fetched URLs, the validators (ETag and
+    Last-Modified) that came with the response, together with the
+    response itself.   FluidDB uses these to make conditional GET
+    requests (If-None-Match, If-Modified-Since), and answers
+    304 (Not Modified) responses from here, so unchanged
+    bodies aren't downloaded again.
+
+    At most maxEntries URLs and maxBytes bytes of body are kept,
+    least recently used first out.
+    """
+    def __init__(self, maxEntries=VALIDATOR_ENTRIES, maxBytes=VALIDATOR_BYTES):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()    # url -> (response, content)
+        self.nBytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.entries[url] = entry
+            return entry
+
+    def conditional_headers(self, url):
+        """Returns the headers to make a request for url conditional."""
+        return self.conditional(url)[1]
+
+    def conditional(self, url):
+        """Returns the entry (response, content) remembered for url,
+           or None, and the headers to make a request for it conditional
+           on that entry, which is what should answer a 304 for it,
+           even if it has been evicted since."""
+        entry = self.get(url)
+        headers = {}
+        if entry:
+            response = entry[0]
+            if u'etag' in response:
+                headers[u'If-None-Match'] = response[u'etag']
+            if u'last-modified' in response:
+                headers[u'If-Modified-Since'] = response[u'last-modified']
+        return entry, headers
+
+    def put(self, url, response, content):
+        if not (u'etag' in response or u'last-modified' in response):
+            self.invalidate(url)
+            return
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old:
+                self.nBytes -= len(old[1])
+            if len(content) > self.maxBytes:
+                return
+            self.entries[url] = (response, content)
+            self.nBytes += len(content)
+            while (len(self.entries) > self.maxEntries
+                   or self.nBytes > self.maxBytes):
+                url, (response, content) = self.entries.popitem(last=False)
+                self.nBytes -= len(content)
+
+    def invalidate(self, url):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old:
+                self.nBytes -= len(old[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+
+_about_id_caches = {}
+_about_id_caches_lock = threading.Lock()
+
+
+def about_id_cache(host):
+    """Returns the (process-wide) AboutIDCache for host,
+       stored under the user's home directory."""
+    with _about_id_caches_lock:
+        if not host in _about_id_caches:
+            name = u'ids-%s.json' % re.sub(ur'[^A-Za-z0-9.\-]+', u'_', host)
+            filename = os.path.join(get_cache_dir(), name)
+            _about_id_caches[host] = AboutIDCache(host, filename)
+        return _about_id_caches[host]
+
+
+@atexit.register
+def _save_about_id_caches():
+    for cache in _about_id_caches.values():
+        cache.save()
+
+
+def about_query(abouts):
+    """Returns a query matching the objects with any of the
+       about values given."""
+    return u' or '.join(u'fluiddb/about = "%s"'
+                        % a.replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+                        for a in abouts)
+
+
 def _get_http(timeout):
     try:
         http = Http(timeout=timeout)
@@ -198,6 +531,388 @@ def _get_http(timeout):
     return http
 
 
+def _close_http(http):
+    for conn in http.connections.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    http.connections.clear()
+
+
+class Metrics:
+    """
+    Thread-safe counters for the requests made through a FluidDB instance,
+    e.g. db.metrics[u'requests'].   Unused counters read as zero.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def __getitem__(self, name):
+        return self.counts.get(name, 0)
+
+    def __unicode__(self):
+        keys = self.counts.keys()
+        keys.sort()
+        return u', '.join(u'%s: %d' % (k, self.counts[k]) for k in keys)
+
+
+class RetryPolicy:
+    """
+    Decides whether, and after how long, FluidDB retries a request
+    that failed transiently: that got one of the given statuses, or
+    raised one of the given exceptions (e.g. a timeout or a
+    connection reset).
+
+    A request is made at most attempts times.   The delay before
+    retry n (counting from 1) is base * 2 ** (n - 1) seconds,
+    capped at cap, or the server's Retry-After if that's longer
+    (still capped).   With jitter, the delay is instead chosen
+    uniformly between zero and that, so that many clients
+    (or threads) that failed together don't all retry together.
+
+    Only idempotent requests are retried: those using the methods
+    in IDEMPOTENT_METHODS, unless the caller says otherwise
+    (as create_object does for a POST with an about tag, which
+    can safely be repeated).
+    """
+    def __init__(self, attempts=RETRY_ATTEMPTS, base=RETRY_BASE,
+                 cap=RETRY_CAP, jitter=True, statuses=RETRY_STATUSES,
+                 exceptions=(socket.error, httplib.HTTPException)):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.statuses = statuses
+        self.exceptions = exceptions
+
+    def retryable(self, method, attempt, status=None, error=None,
+                  idempotent=None):
+        """Returns True if a request that has been made attempt times,
+           and got the status (or raised the error) given, should be
+           made again."""
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if not idempotent or attempt >= self.attempts:
+            return False
+        if error is not None:
+            return isinstance(error, self.exceptions)
+        return status in self.statuses
+
+    def delay(self, attempt, retryAfter=None):
+        """Returns the number of seconds to wait before retrying
+           a request that has been made attempt times."""
+        d = min(self.cap, self.base * 2 ** (attempt - 1))
+        if self.jitter:
+            d = random.uniform(0, d)
+        if retryAfter is not None:
+            try:
+                d = max(d, min(self.cap, float(retryAfter)))
+            except ValueError:
+                pass    # an HTTP date; use our own delay
+        return d
+
+
+class RateLimiter:
+    """
+    A token bucket limiting requests to rate per second on average,
+    with bursts of up to burst requests (by default, one second's worth).
+    acquire() blocks until a request may be made.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst or rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one if necessary.
+           Returns: the number of seconds waited."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1        # reserved, even if we have to wait
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _host_key(host):
+    if not host.startswith(u'http'):
+        host = u'http://%s' % host
+    return urlparse.urlsplit(host).netloc.lower()
+
+
+def set_rate_limit(host, rate, burst=None):
+    """Limits the requests made to host by all FluidDB instances
+       in this process to rate per second (see RateLimiter).
+       A rate of None removes the limit."""
+    with _rate_limiters_lock:
+        if rate is None:
+            _rate_limiters.pop(_host_key(host), None)
+        else:
+            _rate_limiters[_host_key(host)] = RateLimiter(rate, burst)
+
+
+def rate_limiter(host):
+    """Returns the RateLimiter for host, or None if it isn't limited."""
+    return _rate_limiters.get(_host_key(host))
+
+
+class ConcurrencyController:
+    """
+    Adapts the number of requests a FluidDB instance has in flight
+    at once, between minimum and maximum, AIMD-style (as TCP does):
+    each request that completes adds 1/limit to the limit (so about
+    one per round of requests), while a failure or a sign of
+    throttling (see CONGESTION_STATUSES) cuts the limit by the factor
+    decrease, at most once per round trip.   The minimum defaults to
+    half the maximum, so a busy server slows things down without
+    undoing the concurrency asked for.
+
+    Latency alone doesn't count against the server unless tolerance
+    is given, in which case a request taking more than tolerance times
+    the fastest one seen is treated as a sign of congestion too.
+
+    This is useful with many threads (e.g. a WorkerPool, or an
+    AsyncFluidDB) sharing a FluidDB: threads beyond the current
+    limit wait in acquire().
+    """
+    def __init__(self, maximum, minimum=None, initial=None,
+                 tolerance=None, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum or max(1, (maximum + 1) // 2)
+        self.limit = float(initial or maximum)
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.inFlight = 0
+        self.bestLatency = None
+        self.lastDecrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Waits until a request may be made.
+           Returns: the start time, to pass to release."""
+        with self.cond:
+            while self.inFlight >= int(self.limit):
+                self.cond.wait()
+            self.inFlight += 1
+        return time.time()
+
+    def release(self, started, ok=True):
+        """Records the end of a request begun at started,
+           which succeeded (from the server's point of view) if ok."""
+        now = time.time()
+        latency = now - started
+        with self.cond:
+            self.inFlight -= 1
+            if ok and (self.bestLatency is None
+                       or latency < self.bestLatency):
+                self.bestLatency = latency
+            # (latencies under 10ms are too noisy to count as slow)
+            congested = not ok or (self.tolerance is not None
+                                   and latency > self.tolerance
+                                                 * max(self.bestLatency, 0.01))
+            if not congested:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif now - self.lastDecrease > latency:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.lastDecrease = now
+            self.cond.notify_all()
+
+
+class ConnectionPool:
+    """
+    Keeps httplib2.Http objects (and so their open, keep-alive
+    connections) between requests, per host, so that a sequence of
+    calls to the same host doesn't pay for a new TCP (and TLS) handshake
+    every time.
+
+    At most maxSize idle connections are kept for each host;
+    any that have been idle for more than idleTimeout seconds
+    are closed rather than reused.
+
+    The pool is thread-safe: a connection is used by only one
+    request at a time, and extra connections are opened as needed
+    when several requests are in flight at once.
+    """
+    def __init__(self, maxSize=POOL_SIZE, idleTimeout=POOL_IDLE_TIMEOUT):
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.idle = {}          # (scheme, netloc, timeout) -> [(t, http)]
+        self.lock = threading.Lock()
+
+    def key(self, url, timeout):
+        parts = urlparse.urlsplit(url)
+        return (parts.scheme, parts.netloc.lower(), timeout)
+
+    def acquire(self, url, timeout):
+        """Returns a 2-tuple of an Http object for the url's host
+           and a flag saying whether it was reused from the pool."""
+        key = self.key(url, timeout)
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                lastUsed, http = conns.pop()
+                if now - lastUsed <= self.idleTimeout:
+                    return http, True
+                _close_http(http)
+        return _get_http(timeout), False
+
+    def release(self, url, timeout, http):
+        """Returns http to the pool after a successful request."""
+        key = self.key(url, timeout)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxSize:
+                conns.append((time.time(), http))
+                return
+        _close_http(http)
+
+    def discard(self, http):
+        """Closes http without returning it (e.g. after an error)."""
+        _close_http(http)
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for (lastUsed, http) in conns:
+                _close_http(http)
+
+    def size(self, url=None, timeout=None):
+        with self.lock:
+            if url is None:
+                return sum(len(conns) for conns in self.idle.values())
+            return len(self.idle.get(self.key(url, timeout), []))
+
+
+class Pending:
+    """
+    The eventual result of a function submitted to a WorkerPool.
+
+    result() waits for the function to finish and returns its value,
+    or re-raises the exception it raised; error() returns the exception
+    (or None) without raising it.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.excInfo = None
+
+    def run(self, f, args, kwargs):
+        try:
+            self.value = f(*args, **kwargs)
+        except Exception:
+            self.excInfo = sys.exc_info()
+        self.event.set()
+
+    def done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.done()
+
+    def error(self):
+        self.event.wait()
+        return self.excInfo[1] if self.excInfo else None
+
+    def result(self):
+        self.event.wait()
+        if self.excInfo:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+
+_worker_pools = weakref.WeakSet()
+
+
+@atexit.register
+def _close_worker_pools():
+    for workers in list(_worker_pools):
+        workers.close()
+
+
+class WorkerPool:
+    """
+    A bounded pool of worker threads for running blocking FluidDB calls
+    concurrently.   At most jobs functions run at once; with jobs=1,
+    functions are simply run in the calling thread as they are submitted.
+
+    Threads are started when first needed and are daemonic, so an
+    unclosed pool doesn't stop the interpreter from exiting.
+    """
+    def __init__(self, jobs=JOBS):
+        self.jobs = max(1, int(jobs))
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start_workers(self):
+        with self.lock:
+            _worker_pools.add(self)
+            while len(self.threads) < self.jobs:
+                t = threading.Thread(target=self._work)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            pending, f, args, kwargs = task
+            pending.run(f, args, kwargs)
+
+    def submit(self, f, *args, **kwargs):
+        """Schedules f(*args, **kwargs); returns a Pending for the result."""
+        pending = Pending()
+        if self.jobs == 1:
+            pending.run(f, args, kwargs)
+        else:
+            self._start_workers()
+            self.queue.put((pending, f, args, kwargs))
+        return pending
+
+    def submit_all(self, f, items):
+        """Schedules f(item) for each item; returns a list of Pendings
+           in the same order as items."""
+        return [self.submit(f, item) for item in items]
+
+    def map(self, f, items):
+        """Like map(f, items), but running up to jobs calls at once.
+           Results are in the same order as items; if any call raised
+           an exception, the first (in order) is re-raised."""
+        return [p.result() for p in self.submit_all(f, items)]
+
+    def close(self, wait=True):
+        """Stops the workers once everything already submitted has run.
+           If wait is False, returns without waiting for that to happen."""
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for t in threads:
+            self.queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+
 class O:
     """
     This is really a dummy class that just sticks everything in
@@ -287,10 +1002,15 @@ class FluidDB:
     Although currently unused, the unixStylePaths parameter
     can be used to choose whether to use unix-style paths for tags,
     namespaces etc.
+
+    All requests go through a ConnectionPool (pool) so that connections
+    are kept alive between calls.   A pool can be shared between several
+    FluidDB instances by passing it in; otherwise each instance gets
+    its own.
     """
 
     def __init__(self, credentials=None, host=None, debug=False,
-                 encoding=DEFAULT_ENCODING, unixStylePaths=None):
+                 encoding=DEFAULT_ENCODING, unixStylePaths=None, pool=None):
         if credentials == None:
             credentials = Credentials()
         self.credentials = credentials
@@ -314,6 +1034,12 @@ class FluidDB:
         self.headers = {
             u'Authorization': auth
         }
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.metrics = Metrics()
+        self.valueCache = None          # see TagValueCache
+        self.validators = ValidatorStore()
+        self.retry = RetryPolicy()
+        self.controller = None          # see ConcurrencyController
 
     def _get_url(self, host, path, hash, kw):
         """returns URL as unicode
@@ -342,6 +1068,99 @@ class FluidDB:
         if self.timeout == HTTP_TIMEOUT:
             self.timeout = float(v)
 
+    def _request(self, url, method, body, headers, conditional=False,
+                 idempotent=None):
+        """Makes an HTTP request using a connection from the pool,
+           retrying it if it fails transiently, as self.retry allows.
+           idempotent says whether the request can safely be repeated;
+           if None, that depends on the method (see RetryPolicy).
+
+           If conditional is True (for GETs), the request is made
+           conditional on the validators remembered from the last
+           response for the url, if any, and a 304 (Not Modified)
+           response is replaced with that (unchanged) last response.
+           A 304 with nothing to replace it with (the validators were
+           in headers) is answered by asking again without validators.
+
+           Returns: the (response, content) pair from httplib2.
+        """
+        store = self.validators
+        if conditional and store is not None and method == u'GET':
+            (entry, validators) = store.conditional(url)
+            headers = headers.copy()
+            headers.update(validators)
+            response, content = self._request(url, method, body, headers)
+            if response.status == STATUS.NOT_MODIFIED:
+                if entry:
+                    self.metrics.incr(u'not_modified')
+                    return entry
+                for name in (u'If-None-Match', u'If-Modified-Since'):
+                    headers.pop(name, None)
+                response, content = self._request(url, method, body,
+                                                  headers)
+            if response.status == STATUS.OK:
+                store.put(url, response, content)
+            else:
+                store.invalidate(url)
+            return response, content
+        elif store is not None and method != u'GET':
+            store.invalidate(url)
+
+        policy = self.retry
+        attempt = 1
+        while True:
+            retryAfter = None
+            try:
+                response, content = self._send(url, method, body, headers)
+            except Exception, e:
+                if not (policy and policy.retryable(method, attempt,
+                                                    error=e,
+                                                    idempotent=idempotent)):
+                    raise
+                reason = e
+            else:
+                if not (policy and policy.retryable(method, attempt,
+                                                    response.status,
+                                                    idempotent=idempotent)):
+                    return response, content
+                reason = response.status
+                retryAfter = response.get(u'retry-after')
+            delay = policy.delay(attempt, retryAfter)
+            if self.debug:
+                Print(u'Retrying %s %s in %.1fs after %s'
+                      % (method, url, delay, toStr(reason)))
+            self.metrics.incr(u'retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, url, method, body, headers):
+        """Makes a single HTTP request using a connection from the pool,
+           subject to the host's rate limit (see set_rate_limit)
+           and self.controller, if set."""
+        limiter = rate_limiter(self.host)
+        if limiter and limiter.acquire() > 0:
+            self.metrics.incr(u'rate_limited')
+        controller = self.controller
+        if controller:
+            started = controller.acquire()
+        timeout = self.timeout
+        http, reused = self.pool.acquire(url, timeout)
+        self.metrics.incr(u'requests')
+        if reused:
+            self.metrics.incr(u'connections_reused')
+        try:
+            response, content = http.request(url, method, body, headers)
+        except:
+            self.pool.discard(http)
+            if controller:
+                controller.release(started, False)
+            raise
+        self.pool.release(url, timeout, http)
+        if controller:
+            controller.release(started,
+                               response.status not in CONGESTION_STATUSES)
+        return response, content
+
     def call(self, method, path, body=None, hash=None, **kw):
         """
         Calls FluidDB with the attributes given.
@@ -350,6 +1169,13 @@ class FluidDB:
 
         Returns: a 2-tuple consisting of the status and result
         """
+        return self._call(method, path, body, hash, kw)
+
+    def _call(self, method, path, body, hash, kw, conditional=False,
+              idempotent=None):
+        """As call, with the URL parameters as a dictionary (kw),
+           optionally making a conditional request, and saying
+           whether it can safely be retried (see _request)."""
         headers = self.headers.copy()
         if body:
             headers[u'content-type'] = u'application/json'
@@ -369,8 +1195,8 @@ class FluidDB:
                     Print(u'  %s=%s' % (k, headers[k]))
         body8 = body.encode('UTF-8') if type(body) == unicode else body
 
-        http = _get_http(self.timeout)
-        response, content = http.request(url, method, body8, headers)
+        response, content = self._request(url, method, body8, headers,
+                                          conditional, idempotent)
         status = response.status
         if response[u'content-type'].startswith(u'application/json'):
             result = json.loads(content)
@@ -386,13 +1212,37 @@ class FluidDB:
 
         return status, result
 
+    def _call_if_changed(self, path, kw, validators):
+        """Makes a GET request for path, with the URL parameters kw,
+           conditional on validators (a dictionary holding the etag
+           and last-modified from an earlier response, if known)
+           rather than on self.validators, and updates validators
+           from the response if the content has changed.
+
+           Returns (status, result), as _call, but with status
+           NOT_MODIFIED (and no result) if the content hasn't changed."""
+        headers = self.headers.copy()
+        if u'etag' in validators:
+            headers[u'If-None-Match'] = validators[u'etag']
+        if u'last-modified' in validators:
+            headers[u'If-Modified-Since'] = validators[u'last-modified']
+        url = self._get_url(self.host, path, None, kw)
+        response, content = self._request(url, u'GET', None, headers)
+        if response.status != STATUS.OK:
+            return response.status, None
+        validators.clear()
+        for header in (u'etag', u'last-modified'):
+            if header in response:
+                validators[header] = response[header]
+        return response.status, json.loads(content)
+
     def _get_tag_value(self, path):
         headers = self.headers.copy()
         url = self._get_url(self.host, path, hash=None, kw=None)
-        http = _get_http(self.timeout)
         if self.debug:
             Print(u'\nShow URL: %s' % url)
-        response, content = http.request(url, u'GET', None, headers)
+        response, content = self._request(url, u'GET', None, headers,
+                                          conditional=True)
         content_type = response[u'content-type']
         if content_type == PRIMITIVE_CONTENT_TYPE:
             result = json.loads(content)
@@ -408,12 +1258,11 @@ class FluidDB:
             value_type = PRIMITIVE_CONTENT_TYPE
         headers[u'content-type'] = value_type
         url = self._get_url(self.host, path, hash=None, kw=None)
-        http = _get_http(self.timeout)
         if self.debug:
             Print(u'\nTag URL: %s' % url)
             Print(u'Value: %s' % value)
-        response, content = http.request(url, u'PUT', value.encode('UTF-8'),
-                                         headers)
+        response, content = self._request(url, u'PUT', value.encode('UTF-8'),
+                                          headers)
         return response.status, content
 
     def create_object(self, about=None):
@@ -430,8 +1279,51 @@ class FluidDB:
             body = json.dumps({u'about': about})
         else:
             body = None
-        (status, o) = self.call(u'POST', u'/objects', body)
-        return O(o) if status == STATUS.CREATED else status
+        # Creating an object with an about tag is idempotent, so retry it
+        (status, o) = self._call(u'POST', u'/objects', body, None, {},
+                                 idempotent=bool(about))
+        if status == STATUS.CREATED:
+            if about:
+                about_id_cache(self.host).put(about, o[u'id'])
+            return O(o)
+        return status
+
+    def get_object_id(self, about):
+        """
+        Returns the ID of the object with the about tag given,
+        creating the object if necessary.
+
+        IDs are remembered (see AboutIDCache), so only the first lookup
+        of each about value on each host costs a round trip.
+
+        If there's a failure, the return value is an integer error code.
+        """
+        id = about_id_cache(self.host).get(about)
+        if id is not None:
+            return id
+        o = self.create_object(about)
+        return o if type(o) == types.IntType else o.id
+
+    def warm_about_ids(self, abouts, batchSize=ID_WARM_BATCH):
+        """
+        Looks up the IDs of any of the about values given that aren't
+        already cached, batchSize at a time, with a single query each,
+        and remembers them.   Objects that don't exist are not created.
+
+        Returns the number of about values that are now cached.
+        """
+        cache = about_id_cache(self.host)
+        missing = [a for a in set(abouts) if cache.get(a) is None]
+        for i in range(0, len(missing), batchSize):
+            batch = missing[i:i + batchSize]
+            status, H = get_raw_values(self, about_query(batch),
+                                       [u'fluiddb/about'])
+            if status == STATUS.OK:
+                for id in H:
+                    about = H[id].get(u'fluiddb/about', {}).get(u'value')
+                    if about is not None:
+                        cache.put(about, id)
+        return len([a for a in set(abouts) if cache.get(a) is not None])
 
     def create_namespace(self, path, description=u'',
                          createParentIfNeeded=True, verbose=False):
@@ -563,6 +1455,88 @@ class FluidDB:
                         u' the required namespace %s' % namespace)
         return O(o) if status == STATUS.CREATED else status
 
+    def ensure_tags_exist(self, tags, inPref=False, jobs=ENSURE_JOBS):
+        """
+        Makes sure that the (abstract) tags given exist, creating any
+        that don't, and any namespaces they need, before they are used,
+        so that tagging doesn't have to discover that a tag is missing
+        from a failed request, and create it, one tag at a time.
+
+        Each namespace containing the tags is listed once, to find the
+        tags that are missing (as are any of its ancestors that turn out
+        not to exist); then the missing namespaces are created,
+        shallowest first, and then the missing tags, with up to jobs
+        requests at once.   Anything that turns out to have been created
+        in the meantime (PRECONDITION_FAILED) counts as existing.
+
+        Returns: a dictionary mapping the absolute path of each tag that
+        couldn't be created to the error code, so empty if all is well.
+        """
+        paths = sorted(set(self.abs_tag_path(tag, inPref=inPref)[1:]
+                           for tag in tags))
+        workers = WorkerPool(jobs)
+        if self.pool.maxSize < workers.jobs:
+            self.pool.maxSize = workers.jobs
+
+        def parent(path):
+            return path.rsplit(u'/', 1)[0]
+
+        def tag_names(ns):
+            (status, L) = self._call(u'GET', u'/namespaces/%s' % ns, None,
+                                     None, {u'returnTags': True},
+                                     conditional=True)
+            return L[u'tagNames'] if status == STATUS.OK else status
+
+        def needs_creating(path):
+            L = listings[parent(path)]
+            if L == STATUS.NOT_FOUND:
+                return not parent(path) in failed
+            # (tags in namespaces that can't be listed are left alone)
+            return (type(L) != types.IntType
+                    and not path.rsplit(u'/', 1)[1] in L)
+
+        def ok(result):     # an ID, an O, or PRECONDITION_FAILED
+            return type(result) != types.IntType or result == \
+                STATUS.PRECONDITION_FAILED
+
+        try:
+            listings = {}   # namespace -> its tag names, or error status
+            todo = set(parent(path) for path in paths)
+            while todo:     # list the parents of any that don't exist, too
+                todo = sorted(todo)
+                listings.update(zip(todo, workers.map(tag_names, todo)))
+                todo = set(parent(ns) for ns in todo
+                           if listings[ns] == STATUS.NOT_FOUND and u'/' in ns
+                              and not parent(ns) in listings)
+            missing = [ns for ns in listings
+                       if listings[ns] == STATUS.NOT_FOUND]
+            failed = {}     # missing namespace -> error status
+            for depth in sorted(set(ns.count(u'/') for ns in missing)):
+                level = []
+                for ns in sorted(ns for ns in missing
+                                 if ns.count(u'/') == depth):
+                    if not u'/' in ns:          # no such user
+                        failed[ns] = STATUS.NOT_FOUND
+                    elif parent(ns) in failed:
+                        failed[ns] = failed[parent(ns)]
+                    else:
+                        level.append(ns)
+                results = workers.map(lambda ns: self.create_namespace(
+                                          u'/' + ns, createParentIfNeeded=False),
+                                      level)
+                failed.update((ns, r) for (ns, r) in zip(level, results)
+                              if not ok(r))
+            failures = dict((u'/' + path, failed[parent(path)])
+                            for path in paths if parent(path) in failed)
+            newTags = [path for path in paths if needs_creating(path)]
+            results = workers.map(lambda path: self.create_abstract_tag(
+                                      u'/' + path), newTags)
+            failures.update((u'/' + path, r) for (path, r)
+                            in zip(newTags, results) if not ok(r))
+            return failures
+        finally:
+            workers.close()
+
     def delete_abstract_tag(self, tag):
         """Deletes an abstract tag, removing all of its concrete
            instances from objects.   Use with care.
@@ -573,6 +1547,7 @@ class FluidDB:
         """
         fullTag = self.full_tag_path(tag)
         (status, o) = self.call('DELETE', fullTag)
+        self._forget_tag_values(fullTag)
         return 0 if status == STATUS.NO_CONTENT else status
 
     def path_parts(self, byAbout, spec, tag=None, inPref=False):
@@ -583,6 +1558,35 @@ class FluidDB:
         else:
             return base
 
+    def _value_cache_key(self, spec, byAbout, tag, inPref=False):
+        """Returns the valueCache key for the tag on the object, or None
+           if the object is given by an about value whose ID isn't known."""
+        if byAbout:
+            spec = about_id_cache(self.host).get(spec)
+            if spec is None:
+                return None
+        return (self.host, spec, self.abs_tag_path(tag, inPref=inPref))
+
+    def _forget_tag_value(self, spec, byAbout, tag, inPref=False,
+                          result=None, nBytes=0):
+        """Updates the valueCache after a change to a tag on an object:
+           the entry is replaced with result, if given, or removed."""
+        cache = self.valueCache
+        if cache is None:
+            return
+        key = self._value_cache_key(spec, byAbout, tag, inPref)
+        if key is None:
+            cache.invalidate_tag(self.host, self.abs_tag_path(tag, inPref))
+        elif result is None:
+            cache.invalidate(key)
+        else:
+            cache.put(key, result, nBytes)
+
+    def _forget_tag_values(self, tag):
+        """Removes the valueCache entries for the tag on all objects."""
+        if self.valueCache is not None:
+            self.valueCache.invalidate_tag(self.host, self.abs_tag_path(tag))
+
     def tag_object(self, spec, tag, byAbout, value=None, value_type=None,
                    createAbstractTagIfNeeded=True, inPref=False):
                          
@@ -594,13 +1598,19 @@ class FluidDB:
         """
         objTagParts = self.path_parts(byAbout, spec, tag, inPref)
         (status, o) = self._set_tag_value(objTagParts, value, value_type)
+        if status == STATUS.NO_CONTENT and value_type is None:
+            self._forget_tag_value(spec, byAbout, tag, inPref,
+                                   (STATUS.OK, value),
+                                   len(json.dumps(value)))
+        else:
+            self._forget_tag_value(spec, byAbout, tag, inPref)
         if status == STATUS.NOT_FOUND and createAbstractTagIfNeeded:
-            o = self.create_abstract_tag(tag)
+            o = self.create_abstract_tag(self.abs_tag_path(tag, inPref=inPref))
             if type(o) == types.IntType:       # error code
                 return o
             else:
                 return self.tag_object(spec, tag, byAbout, value, value_type,
-                                       False)
+                                       False, inPref)
         else:
             return 0 if status == STATUS.NO_CONTENT else status
 
@@ -629,17 +1639,20 @@ class FluidDB:
         """
         objTagParts = self.path_parts(byAbout, spec, tag, inPref)
         (status, o) = self.call('DELETE', objTagParts)
+        self._forget_tag_value(spec, byAbout, tag, inPref)
         ok = (status == STATUS.NO_CONTENT
               or status == STATUS.NOT_FOUND and missingConstitutesSuccess)
         return 0 if ok else status
 
     def untag_object_by_id(self, id, tag, missingConstitutesSuccess=True,
                            inPref=False):
-        return self.untag_object(id, tag, False, True, inPref)
+        return self.untag_object(id, tag, False, missingConstitutesSuccess,
+                                 inPref)
 
     def untag_object_by_about(self, about, tag, missingConstitutesSuccess=True,
                               inPref=False):
-        return self.untag_object(about, tag, True, True, inPref)
+        return self.untag_object(about, tag, True, missingConstitutesSuccess,
+                                 inPref)
 
 
     def get_tag_value(self, spec, tag, byAbout, inPref=False):
@@ -653,9 +1666,21 @@ class FluidDB:
            is the status, and the second is either the tag value,
            if the return stats is STATUS.OK, or None otherwise.
         """
+        cache = self.valueCache
+        key = cache and self._value_cache_key(spec, byAbout, tag, inPref)
+        if key:
+            result = cache.get(key)
+            if result:
+                self.metrics.incr(u'value_cache_hits')
+                return result
         objTagParts = self.path_parts(byAbout, spec, tag, inPref)
         status, (value, value_type) = self._get_tag_value(objTagParts)
-        return status, (value if status == STATUS.OK else None)
+        result = status, (value if status == STATUS.OK else None)
+        if key and status in (STATUS.OK, STATUS.NOT_FOUND):
+            nBytes = (len(json.dumps(value)) if value_type is None
+                      else len(value))
+            cache.put(key, result, nBytes)
+        return result
 
     def get_tag_value_by_id(self, id, tag, inPref=False):
         return self.get_tag_value(id, tag, False, inPref)
@@ -967,11 +1992,53 @@ def tag_by_query(db, query, tagsToSet):
 
 
     """
-    strHash = u'{%s}' % u', '.join(u'"%s": {"value": %s}'
-                                   % (tag, format_val(tagsToSet[tag]))
-                                   for tag in tagsToSet)
-    (v, r) = db.call(u'PUT', u'/values', strHash, {u'query': query})
-    assert_status(v, STATUS.NO_CONTENT)
+    assert_status(put_values(db, query, tagsToSet), STATUS.NO_CONTENT)
+
+
+def put_values(db, query, tagsToSet):
+    """
+    As tag_by_query, but returns the HTTP status (STATUS.NO_CONTENT
+    on success) instead of raising BadStatusError on failure.
+    """
+    body = json.dumps(dict((tag, {u'value': tagsToSet[tag]})
+                           for tag in tagsToSet))
+    (v, r) = db.call(u'PUT', u'/values', body, {u'query': query})
+    for tag in tagsToSet:
+        db._forget_tag_values(u'/' + tag)
+    return v
+
+
+def untag_by_query(db, query, tags):
+    """
+    Removes one or more tags from every object that matches a query.
+
+    db         is an instantiated FluidDB instance.
+
+    query      is a unicode string representing a valid Fluidinfo query.
+
+    tags       is a list (or tuple) of the tags to be removed.
+
+    Example:
+
+        db = FluidDB()
+        untag_by_query(db, u'has njr/rating', (u'njr/rated',))
+
+    NOTE: As for tag_by_query, tags need to be full paths without
+    a leading slash.
+    """
+    assert_status(delete_values(db, query, tags), STATUS.NO_CONTENT)
+
+
+def delete_values(db, query, tags):
+    """
+    As untag_by_query, but returns the HTTP status (STATUS.NO_CONTENT
+    on success) instead of raising BadStatusError on failure.
+    """
+    (v, r) = db.call(u'DELETE', u'/values', None, {u'query': query,
+                                                   u'tag': tags})
+    for tag in tags:
+        db._forget_tag_values(u'/' + tag)
+    return v
 
 
 def assert_status(v, s):
@@ -1005,10 +2072,8 @@ def get_values(db, query, tags):
     NOTE: All strings must be (and will be) unicode.
 
     """
-    (v, r) = db.call(u'GET', u'/values', None, {u'query': query,
-                                                u'tag': tags})
+    (v, H) = get_raw_values(db, query, tags)
     assert_status(v, STATUS.OK)
-    H = r[u'results'][u'id']
     results = []
     for id in H:
         o = O()
@@ -1018,6 +2083,34 @@ def get_values(db, query, tags):
         results.append(o)
     return results      # hash of objects, keyed on ID, with attributes
                         # corresponding to tags, inc id.
+
+
+def get_raw_values(db, query, tags):
+    """
+    Gets the values of a set of tags on the objects satisfying a given
+    query, as returned by Fluidinfo.
+
+    Returns a 2-tuple of the status and, if that is STATUS.OK,
+    a dictionary keyed on object ID.   For each object, this maps
+    each tag present to a dictionary holding either its value (u'value')
+    or, for opaque (non-primitive) values, its u'value-type' and u'size'.
+    Tags the object doesn't have are absent.
+
+    Tags are full paths without a leading slash, as for get_values.
+    They are asked for VALUES_TAGS at a time, so that the URL stays
+    a reasonable length however many there are; if any request fails,
+    its status is returned.
+    """
+    tags = list(tags)
+    H = {}
+    for i in range(0, max(len(tags), 1), VALUES_TAGS):
+        (v, r) = db.call(u'GET', u'/values', None,
+                         {u'query': query, u'tag': tags[i:i + VALUES_TAGS]})
+        if v != STATUS.OK:
+            return v, None
+        for (id, values) in r[u'results'][u'id'].iteritems():
+            H.setdefault(id, {}).update(values)
+    return v, H
         
 
 def path_style(options):
@@ -1,9 +1,19 @@
+import atexit
+import copy
 import math
+import os
+import re
 import sys
+import threading
+import time
 import types
 import fdblib
+import nstree
+import snapshot
 import cli
 from fdblib import Print
+from nstree import (PermissionDesc, RAW_PERMS, RAW_PERM_ENTITIES,
+                    WALK_JOBS, WALK_LOOKAHEAD, PERM_JOBS, PERM_LOOKAHEAD)
 
 if sys.version_info < (2, 6):
     try:
@@ -13,6 +23,10 @@ if sys.version_info < (2, 6):
 else:
     import json
 
+GRID_PAGE = 500         # items laid out together by ls's grid format
+PERMS_CACHE_TTL = 300.0 # seconds a cached permission is trusted
+RM_JOBS = 8             # tags or namespaces deleted at once by rm -r
+
 
 class PermissionsError(Exception):
     pass
@@ -22,33 +36,6 @@ class WisdomFailure(Exception):
     pass
 
 
-class PermissionDesc:
-    def __init__(self, entity, path, actions, names):
-        self.entity = entity
-        self.path = path
-        self.actions = actions
-        self.names = names
-
-    def action(self, name):
-        return self.actions[self.names.index(name)]
-
-
-RAW_PERMS = {
-    u'abstract-tag': PermissionDesc(u'abstract-tag', u'tags',
-                                    [u'update', u'delete', u'control'],
-                                    [u'metadata', u'delete', u'acontrol']),
-    u'tag': PermissionDesc(u'tag', u'tag-values',
-                           [u'create', u'read', u'delete', u'control'],
-                           [u'tag', u'read', u'untag', 'tcontrol']),
-    u'namespace': PermissionDesc(u'namespace', u'namespaces',
-                                 [u'create', u'update', u'delete', u'list',
-                                  u'control'],
-                                 [u'create', u'metadata', u'delete', u'read',
-                                  u'control'])
-}
-
-RAW_PERM_ENTITIES = RAW_PERMS.keys()
-
 READ_NAMES = [u'read']
 WRITE_NAMES = [u'create', u'metadata', 'tag', 'untag', 'delete']
 CONTROL_NAMES = [u'acontrol', u'tcontrol']
@@ -130,7 +117,10 @@ class FluidinfoPerm:
 
 
 class FluidinfoPerms:
-    def __init__(self, db, path, isTag, getFromFI=True, isPolicy=False):
+    def __init__(self, db, path, isTag, getFromFI=True, isPolicy=False,
+                 hash=None):
+        # hash, if given, holds the permissions already fetched
+        # (see ExtendedFluidDB.perms_hashes)
         self.isTag = isTag
         self.isPolicy = isPolicy
         self.path = path
@@ -140,7 +130,9 @@ class FluidinfoPerms:
         for entity in self.entities:
             desc = RAW_PERMS[entity]
             for (action, name) in zip(desc.actions, desc.names):
-                if getFromFI:
+                if hash:
+                    self.__dict__[name] = hash[name]
+                elif getFromFI:
                     if isPolicy:
                         self.__dict__[name] = db.get_raw_policy(entity,
                                                                 path[1:],
@@ -197,8 +189,17 @@ class FluidinfoPerms:
                 self.__dict__[name].policy = u'closed'
                 self.__dict__[name].exceptions = [self.owner]
 
-    def update_fluidinfo(self, db):
-
+    def update_fluidinfo(self, db, jobs=PERM_JOBS, current=None):
+        """Writes these permissions to Fluidinfo, where they differ from
+           the permissions there now, making up to jobs requests at once.
+           current, if given, maps the name of each permission to what
+           is there now (as yielded by db.perms_hashes with fresh=True);
+           otherwise they are read afresh by db, not from its cache or
+           snapshot, which could be out of date.
+
+           Returns: a pair of lists of the names (read, metadata, ...)
+           of the permissions changed and the permissions left unchanged.
+        """
         # check owner has control permissions
         for name in CONTROL_NAMES:
             if hasattr(self, name):
@@ -208,14 +209,46 @@ class FluidinfoPerms:
                     assert self.owner in self.__dict__[name].exceptions
 
         entities = (u'abstract-tag', u'tag') if self.isTag else (u'namespace',)
-        for entity in entities:
-            for name in RAW_PERMS[entity].names:
-                action = RAW_PERMS[entity].action(name)
-                err = db.set_raw_perm(entity, self.path[1:], action,
-                                      self.__dict__[name].policy,
-                                      self.__dict__[name].exceptions)
-                if err:
-                    cli.warning(cli.error_code(err))
+        perms = [(entity, name, action) for entity in entities
+                 for (action, name) in zip(RAW_PERMS[entity].actions,
+                                           RAW_PERMS[entity].names)]
+
+        def read((entity, name, action)):
+            return db.get_raw_perm(entity, self.path[1:], action, self.isTag,
+                                   fresh=True)
+
+        def write(change):
+            (entity, name) = change
+            return db.set_raw_perm(entity, self.path[1:],
+                                   RAW_PERMS[entity].action(name),
+                                   self.__dict__[name].policy,
+                                   self.__dict__[name].exceptions)
+
+        workers = fdblib.WorkerPool(jobs)
+        if db.pool.maxSize < workers.jobs:
+            db.pool.maxSize = workers.jobs
+        try:
+            if current is None:
+                current = dict((name, old) for ((entity, name, action), old)
+                               in zip(perms, workers.map(read, perms)))
+            changes = []
+            unchanged = []
+            for (entity, name, action) in perms:
+                old = current[name]
+                perm = self.__dict__[name]
+                if (type(old) != types.IntType and old.policy == perm.policy
+                        and set(old.exceptions) == set(perm.exceptions)):
+                    unchanged.append(name)
+                else:
+                    changes.append((entity, name))
+            errors = workers.map(write, changes)
+        finally:
+            workers.close()
+        for err in errors:
+            if err:
+                cli.warning(cli.error_code(err))
+        return ([name for ((entity, name), err) in zip(changes, errors)
+                 if not err], unchanged)
 
     def fi_tag_desc(self):
         s = []
@@ -292,70 +325,317 @@ def to_string_grid(items, pageWidth=78, maxCols=9):
                                    for row in range(nRows)])
 
 
+class PermsCache:
+    """
+    Remembers the permissions (policy and exceptions) read by
+    get_raw_perm and get_raw_policy, keyed on (entity, path, action),
+    with entity prefixed by policy: for policies.   set_raw_perm
+    updates the entries it changes.
+
+    Entries expire ttl seconds after they are read from Fluidinfo,
+    to limit staleness from changes made elsewhere (including by
+    other processes, when the cache is kept on disk).
+
+    If filename is given, the cache is loaded from there when first
+    used and save() writes it back, merging with anything other
+    processes have saved in the meantime; perms_cache(host) arranges
+    for that to happen when the program exits.
+    """
+    def __init__(self, filename=None, ttl=PERMS_CACHE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {}       # key -> (expiry, hash)
+        self.removed = set()
+        self.loaded = filename is None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.entries.update(self._read())
+
+    def _read(self):
+        try:
+            f = open(self.filename)
+            try:
+                rows = json.load(f)
+            finally:
+                f.close()
+            now = time.time()
+            return dict(((entity, path, action), (expiry, hash))
+                        for (entity, path, action, expiry, hash) in rows
+                        if expiry > now)
+        except (IOError, OSError, ValueError, TypeError):
+            return {}
+
+    def get(self, key):
+        """Returns the cached hash for key, or None."""
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                return None
+            return entry[1]
+
+    def put(self, key, hash):
+        with self.lock:
+            self._load()
+            self.entries[key] = (time.time() + self.ttl, hash)
+            self.removed.discard(key)
+            self.dirty = True
+
+    def invalidate(self, key):
+        with self.lock:
+            self._load()
+            if self.entries.pop(key, None) is not None:
+                self.removed.add(key)
+                self.dirty = True
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return len(self.entries)
+
+    def save(self):
+        """Writes the cache to its file, if it has one and has changed."""
+        with self.lock:
+            if not (self.filename and self.dirty):
+                return
+
+            def merge(entries):
+                for key in self.removed:
+                    entries.pop(key, None)
+                entries.update(self.entries)
+                now = time.time()
+                return [list(key) + [expiry, hash]
+                        for (key, (expiry, hash)) in entries.items()
+                        if expiry > now]
+
+            if fdblib.save_cache_file(self.filename, self._read, merge):
+                self.dirty = False
+
+
+_perms_caches = {}
+_perms_caches_lock = threading.Lock()
+
+
+def perms_cache(host):
+    """Returns the (process-wide) on-disk PermsCache for host,
+       stored under the user's home directory."""
+    with _perms_caches_lock:
+        if not host in _perms_caches:
+            name = u'perms-%s.json' % re.sub(ur'[^A-Za-z0-9.\-]+', u'_', host)
+            filename = os.path.join(fdblib.get_cache_dir(), name)
+            _perms_caches[host] = PermsCache(filename)
+        return _perms_caches[host]
+
+
+@atexit.register
+def _save_perms_caches():
+    for cache in _perms_caches.values():
+        cache.save()
+
+
 class ExtendedFluidDB(fdblib.FluidDB):
     def __init__(self, credentials=None, host=None, debug=False,
-                 encoding=fdblib.DEFAULT_ENCODING, unixStylePaths=None):
+                 encoding=fdblib.DEFAULT_ENCODING, unixStylePaths=None,
+                 pool=None):
         fdblib.FluidDB.__init__(self, credentials, host, debug,
-                                encoding, unixStylePaths)
+                                encoding, unixStylePaths, pool)
+        self.permsCache = PermsCache()  # or perms_cache(host), to persist
+        self.listings = {}              # see cached_listing
+        self.snapshot = None            # see snapshot.Snapshot
 
     def list_namespace(self, ns, returnDescription=True,
-                        returnNamespaces=True, returnTags=True):
-        status, content = self.call(u'GET', u'/namespaces/%s' % ns, None,
-                                    returnDescription=returnDescription,
-                                    returnNamespaces=returnNamespaces,
-                                    returnTags=returnTags)
+                        returnNamespaces=True, returnTags=True,
+                        validators=None):
+        """
+        Returns the listing of ns (its description, and the names of
+        its subnamespaces and tags, as asked for), or an error status.
+
+        If validators is given, the listing is read from Fluidinfo
+        (not any snapshot) only if it has changed since the one
+        validators (a dictionary) came with, which is then updated;
+        if it hasn't, STATUS.NOT_MODIFIED is returned instead
+        (see FluidDB._call_if_changed).
+        """
+        kw = {u'returnDescription': returnDescription,
+              u'returnNamespaces': returnNamespaces,
+              u'returnTags': returnTags}
+        path = u'/namespaces/%s' % ns
+        if validators is not None:
+            status, content = self._call_if_changed(path, kw, validators)
+        else:
+            if self.snapshot is not None:
+                L = self.snapshot.listing(ns, returnDescription,
+                                          returnNamespaces, returnTags)
+                if L is not None:
+                    return L
+            status, content = self._call(u'GET', path, None, None, kw,
+                                         conditional=True)
         return content if status == fdblib.STATUS.OK else status
 
-    def list_r_namespace(self, rootns):
-        L = self.list_namespace(rootns, returnDescription=False)
+    def cached_listing(self, ns):
+        """Returns list_namespace(ns), remembering the result
+           for the life of this object."""
+        if not ns in self.listings:
+            self.listings[ns] = self.list_namespace(ns)
+        return self.listings[ns]
+
+    def path_kind(self, path):
+        """
+        Works out whether the absolute path given (as returned by
+        abs_tag_path) is a tag, a namespace, or both, returning
+        (isTag, isNamespace).
+
+        This normally takes one request, to list the parent namespace,
+        and none if the parent has already been listed (see
+        cached_listing), so resolving many paths in the same namespace
+        is cheap.   The listing of a user's top-level namespace is
+        itself the answer (and is then reused by list_sorted_ns).
+        """
+        parts = path[1:].rsplit(u'/', 1)
+        if len(parts) == 1:
+            L = self.cached_listing(parts[0])
+            return (False, type(L) != types.IntType)
+        (parent, name) = parts
+        L = self.cached_listing(parent)
         if L == fdblib.STATUS.NOT_FOUND:
-            return fdblib.STATUS.NOT_FOUND
-        if type(L) == int:
-            return {u'namespaceNames': [], u'tagNames': [], u'failures': True}
+            return (False, False)
+        elif type(L) == types.IntType:      # e.g. can't list the parent
+            return (self.tag_exists(path), self.ns_exists(path))
+        return (name in L[u'tagNames'], name in L[u'namespaceNames'])
+
+    def walk_namespaces(self, rootns, jobs=WALK_JOBS, depthFirst=False,
+                        lookahead=WALK_LOOKAHEAD, lister=None):
+        """Walks the namespace tree below rootns (see nstree)."""
+        return nstree.walk_namespaces(self, rootns, jobs, depthFirst,
+                                      lookahead, lister)
+
+    def list_r_namespace(self, rootns):
+        namespaces = []
+        tags = []
         failures = False
-        namespaces = [u'%s/%s' % (rootns, space)
-                        for space in L[u'namespaceNames']]
-        tags = [u'%s/%s' % (rootns, tag) for tag in L[u'tagNames']]
-        subns = []
-        subtags = []
-        for s in namespaces:
-            L = self.list_namespace(s, returnDescription=False)
-            if type(L) == int:
+        for (ns, nsTags, nsSpaces) in self.walk_namespaces(rootns):
+            if type(nsTags) == types.IntType:
+                if ns == rootns and nsTags == fdblib.STATUS.NOT_FOUND:
+                    return fdblib.STATUS.NOT_FOUND
                 failures = True
             else:
-                subns.extend([u'%s/%s' % (s, space)
-                                  for space in L[u'namespaceNames']])
-                subtags.extend([u'%s/%s' % (s, space)
-                                  for space in L[u'tagNames']])
-        namespaces.extend(subns)
-        tags.extend(subtags)
+                namespaces.extend([u'%s/%s' % (ns, space)
+                                   for space in nsSpaces])
+                tags.extend([u'%s/%s' % (ns, tag) for tag in nsTags])
         return {u'namespaceNames': namespaces, u'tagNames': tags,
                 u'failures': failures}
 
-    def rm_r(self, rootns):
-        L = self.list_r_namespace(rootns)
-        if L == fdblib.STATUS.NOT_FOUND:
-            return L
-        elif L[u'failures']:
-            return 1            # non-zero failure code
-        # First delete all the tags & sub-namespaces
-        for items, fn in ((L[u'tagNames'], self.delete_abstract_tag),
-                          (L[u'namespaceNames'], self.delete_namespace)):
-            si = [(i.split(u'/'), i) for i in items]
-            z = [(len(s), i) for (s, i) in si]
-            z.sort()
-            z.reverse()
-            failed = False
-            for (n, i) in z:
-                r = self.delete_abstract_tag(u'/%s' % i)
-                failed = failed or (r != fdblib.STATUS.NO_CONTENT)
-        if failed:
-            return 1
-        return self.delete_namespace(u'/' + rootns)
+    def delete_item(self, path, isTag):
+        """Deletes the tag (abstract tag) or namespace at path,
+           returning the status (NO_CONTENT if successful)."""
+        if isTag:
+            return self.delete_abstract_tag(path) or fdblib.STATUS.NO_CONTENT
+        return self.delete_namespace(path)
+
+    def rm_r(self, rootns, jobs=RM_JOBS, dryRun=False, progress=False):
+        """
+        Deletes the namespace rootns and everything below it.
+
+        The whole tree is walked first (see walk_namespaces); then all
+        its tags are deleted, up to jobs at once, and then its
+        namespaces, deepest first, with those at each depth deleted
+        together, since a namespace can only be deleted once it's empty.
+        A namespace that can't be emptied, because something below it
+        couldn't be listed or deleted, isn't tried, and is reported
+        as PRECONDITION_FAILED (as Fluidinfo would).   Anything
+        already gone counts as deleted, so after a partial failure,
+        running rm_r again carries on where it left off.
+
+        If dryRun is True, nothing is deleted, and everything
+        that would be is reported as deleted.   If progress is True,
+        a count is kept on stderr.
+
+        Returns: (deleted, failed), where deleted lists (path, isTag),
+        in the order deleted, and failed lists (path, isTag, status),
+        or the error status if rootns itself can't be listed.
+        """
+        tags = []
+        levels = []             # levels[d] lists namespaces at depth d
+        failed = []
+        blocked = set()         # namespaces that won't be empty
+        depth0 = rootns.count(u'/')
+
+        def block(ns):
+            while ns.count(u'/') >= depth0 and not ns in blocked:
+                blocked.add(ns)
+                ns = ns.rsplit(u'/', 1)[0]
+
+        for (ns, nsTags, nsSpaces) in self.walk_namespaces(rootns, jobs=jobs):
+            if type(nsTags) == types.IntType:
+                if ns == rootns:
+                    return nsTags
+                failed.append((u'/' + ns, False, nsTags))
+                block(ns)
+                continue
+            depth = ns.count(u'/') - depth0
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(ns)
+            tags.extend(u'%s/%s' % (ns, tag) for tag in nsTags)
+
+        total = len(tags) + sum(len(level) for level in levels)
+        done = [0]
+        deleted = []
+        lock = threading.Lock()
+
+        def delete(path, isTag):
+            status = (fdblib.STATUS.NO_CONTENT if dryRun
+                      else self.delete_item(path, isTag))
+            with lock:
+                if status in (fdblib.STATUS.NO_CONTENT,
+                              fdblib.STATUS.NOT_FOUND):
+                    deleted.append((path, isTag))
+                else:
+                    failed.append((path, isTag, status))
+                    block(path[1:].rsplit(u'/', 1)[0])
+                done[0] += 1
+                if progress:
+                    sys.stderr.write(u'\r%d of %d deleted' % (done[0], total))
+
+        workers = fdblib.WorkerPool(jobs)
+        if self.pool.maxSize < workers.jobs:
+            self.pool.maxSize = workers.jobs
+        try:
+            workers.map(lambda tag: delete(u'/' + tag, True), tags)
+            for level in reversed(levels):
+                # blocked only grows from deeper levels, which are done
+                for ns in [ns for ns in level if ns in blocked]:
+                    failed.append((u'/' + ns, False,
+                                   fdblib.STATUS.PRECONDITION_FAILED))
+                    done[0] += 1
+                workers.map(lambda ns: delete(u'/' + ns, False),
+                            [ns for ns in level if not ns in blocked])
+        finally:
+            workers.close()
+        if progress and total:
+            sys.stderr.write(u'\n')
+        return (deleted, failed)
 
     def list_sorted_ns(self, ns, long_=False, columns=True, recurse=False,
                        prnt=False, longer=False):
-        h = self.list_namespace(ns)
+        if recurse:
+            # If printing, each namespace is printed as it arrives,
+            # and nothing is kept
+            results = []
+            for (space, tags, spaces) in self.walk_namespaces(ns,
+                                                      depthFirst=True):
+                h = (tags if type(tags) == types.IntType
+                     else {u'tagNames': tags, u'namespaceNames': spaces})
+                result = self.list_sorted_nshash(h, space, long_, columns,
+                                                 recurse, prnt, longer)
+                if not prnt:
+                    results.append(result)
+            return u'\n\n'.join(results)
+        h = self.cached_listing(ns)
         return self.list_sorted_nshash(h, ns, long_, columns, recurse,
                                        prnt=prnt, longer=longer)
 
@@ -378,69 +658,84 @@ class ExtendedFluidDB(fdblib.FluidDB):
         if recurse:
             Print(u'\n%s:' % ns)
         if long_ or longer:
-            res = []
-            for item in items:
-                r = self.full_perms(ns + u'/' + fmt % item, longer)
-                res.append(r)
-                if prnt:
-                    Print(r)
-            result = u'\n'.join(res)
+            lines = self.iter_full_perms((ns + u'/' + fmt % item
+                                          for item in items), longer)
+        elif not items:
+            lines = [u'']
         elif columns == False:
-            result = u'\n'.join(items)
-            if prnt:
-                Print(result)
+            lines = items
         else:
-            result = to_string_grid(items)
+            lines = (to_string_grid(items[i:i + GRID_PAGE])
+                     for i in range(0, len(items), GRID_PAGE))
+        res = []
+        for line in lines:
             if prnt:
-                Print(result)
+                Print(line)
+            else:
+                res.append(line)
+        result = u'\n'.join(res)
         if recurse:
-            others = u'\n'.join([self.list_sorted_ns(u'%s/%s' % (ns, space),
-                                                     long_, columns, recurse,
-                                                     prnt=prnt, longer=longer)
-                                 for space in spaces])
-            return u'%s:\n%s\n\n%s' % (ns, result, others)
+            return u'%s:\n%s' % (ns, result)
         else:
             return result
 
-    def get_raw_perm(self, entity, name, action, isTag):
+    def get_raw_perm(self, entity, name, action, isTag, fresh=False):
         assert entity in RAW_PERM_ENTITIES
         owner = entity.split(u'/')[0]
         perm = RAW_PERMS[entity]
         assert action in perm.actions
-        path = u'/permissions/%s/%s' % (perm.path, name)
-        status, content = self.call(u'GET', path, None, action=action)
+        content = self._get_cached_perm((entity, name, action),
+                                        u'/permissions/%s/%s'
+                                        % (perm.path, name), fresh)
         return (FluidinfoPerm(owner, hash=content, name=name, action=action,
                               isTag=isTag)
-                if status == fdblib.STATUS.OK else status)
+                if type(content) == dict else content)
 
     def get_raw_policy(self, entity, owner, action):
         assert entity in RAW_PERM_ENTITIES
         perm = RAW_PERMS[entity]
         assert action in perm.actions
-        path = u'/policies/%s/%s/%s' % (owner, perm.path, action)
-        status, content = self.call(u'GET', path, None, action=action)
+        content = self._get_cached_perm((u'policy:' + entity, owner, action),
+                                        u'/policies/%s/%s/%s'
+                                        % (owner, perm.path, action))
         return (FluidinfoPerm(owner, hash=content, name=owner, action=action,
                               isPolicy=True)
-                if status == fdblib.STATUS.OK else status)
+                if type(content) == dict else content)
+
+    def _get_cached_perm(self, key, path, fresh=False):
+        """Returns the permission hash for key (from path), using
+           self.snapshot or self.permsCache if possible (unless fresh
+           is True, when it is read from Fluidinfo, and cached),
+           or an error status."""
+        if self.snapshot is not None and not fresh:
+            content = self.snapshot.perm(*key)
+            if content is not None:
+                return content
+        cache = self.permsCache
+        content = cache.get(key) if cache is not None and not fresh else None
+        if content is None:
+            status, content = self.call(u'GET', path, None, action=key[2])
+            if status != fdblib.STATUS.OK:
+                return status
+            if cache is not None:
+                cache.put(key, content)
+        return content
+
+    def perms_hashes(self, items, jobs=PERM_JOBS, lookahead=PERM_LOOKAHEAD,
+                     fresh=False):
+        """Yields (item, h) with the permissions of each of items
+           (see nstree)."""
+        return nstree.perms_hashes(self, items, jobs, lookahead, fresh)
 
     def get_tag_perms_hash(self, tag):
-        h = {}
-        for entity in [u'abstract-tag', u'tag']:
-            desc = RAW_PERMS[entity]
-            for (action, name) in zip(desc.actions, desc.names):
-                h[name] = self.get_raw_perm(entity, tag, action, True)
-        return h
+        return list(self.perms_hashes([tag]))[0][1]
 
     def get_ns_perms_hash(self, ns):
-        h = {}
-        for entity in [u'namespace']:
-            desc = RAW_PERMS[entity]
-            for (action, name) in zip(desc.actions, desc.names):
-                h[name] = self.get_raw_perm(entity, ns, action, False)
-        return h
+        return list(self.perms_hashes([ns + u'/']))[0][1]
 
-    def tag_perms_string(self, tag, group=False):
-        h = self.get_tag_perms_hash(tag)
+    def tag_perms_string(self, tag, group=False, h=None):
+        if h is None:
+            h = self.get_tag_perms_hash(tag)
         s = []
         owner = tag.split(u'/')[0]
         r = h[u'read']
@@ -486,8 +781,9 @@ class ExtendedFluidDB(fdblib.FluidDB):
                 % (perm.policy,
                    u', '.join(u for u in perm.exceptions)))
 
-    def ns_perms_string(self, ns, group=False):
-        h = self.get_ns_perms_hash(ns)
+    def ns_perms_string(self, ns, group=False, h=None):
+        if h is None:
+            h = self.get_ns_perms_hash(ns)
         s = []
         owner = ns.split(u'/')[0]
         r = h[u'read']
@@ -540,27 +836,33 @@ class ExtendedFluidDB(fdblib.FluidDB):
             gs = u'r:%s  w:%s' % (gr, gw)
         return gs
 
-    def perms_string(self, tagOrNS, longer=False, group=False):
+    def perms_string(self, tagOrNS, longer=False, group=False, h=None):
         tagOrNS = tagOrNS.strip()
         if tagOrNS.endswith(u'/'):
             if longer:
                 return unicode(FluidinfoPerms(self, u'/' + tagOrNS[:-1],
-                                              isTag=False))
+                                              isTag=False, hash=h))
             else:
-                return self.ns_perms_string(tagOrNS[:-1], group)
+                return self.ns_perms_string(tagOrNS[:-1], group, h)
         else:
             if longer:
                 return unicode(FluidinfoPerms(self, u'/' + tagOrNS,
-                                              isTag=True))
+                                              isTag=True, hash=h))
             else:
-                return self.tag_perms_string(tagOrNS, group)
+                return self.tag_perms_string(tagOrNS, group, h)
 
-    def full_perms(self, tagOrNS, longer, group=False):
-        perms = self.perms_string(tagOrNS, longer, group)
+    def full_perms(self, tagOrNS, longer, group=False, h=None):
+        perms = self.perms_string(tagOrNS, longer, group, h)
         if longer:
             return u'\n%s:\n\n%s' % (tagOrNS, perms)
         else:
             return u'%s   %s' % (perms, tagOrNS)
+
+    def iter_full_perms(self, items, longer, group=False):
+        """Yields full_perms for each of items, in order, fetching
+           the permissions for all of them at once (see perms_hashes)."""
+        for (item, h) in self.perms_hashes(items):
+            yield self.full_perms(item, longer, group, h)
                 
     def set_raw_perm(self, entity, path, action, policy, exceptions):
         assert entity in RAW_PERM_ENTITIES
@@ -569,10 +871,17 @@ class ExtendedFluidDB(fdblib.FluidDB):
         assert policy in (u'open', u'closed')
         assert not type(exceptions) in types.StringTypes    # forgot the []
         body = json.dumps({u'policy': policy, u'exceptions': exceptions})
+        key = (entity, path, action)
         path = u'/permissions/%s/%s' % (perm.path, path)
         if self.debug:
             Print(path, body, action)
         status, content = self.call(u'PUT', path, body, action=action)
+        if self.permsCache is not None:
+            if status == fdblib.STATUS.NO_CONTENT:
+                self.permsCache.put(key, {u'policy': policy,
+                                          u'exceptions': list(exceptions)})
+            else:
+                self.permsCache.invalidate(key)
         return 0 if status == fdblib.STATUS.NO_CONTENT else status
 
 
@@ -587,6 +896,10 @@ def execute_ls_command(objs, tags, options, credentials):
     db = ExtendedFluidDB(host=options.hostname, credentials=credentials,
                          debug=options.debug,
                          unixStylePaths=fdblib.path_style(options))
+    if options.permscache:
+        db.permsCache = perms_cache(db.host)
+    if not options.fresh:
+        db.snapshot = snapshot.load_snapshot(db.host, maxAge=options.maxage)
     long_ = options.long or options.group
     if options.policy:
         if len(tags) > 0:
@@ -601,8 +914,9 @@ def execute_ls_command(objs, tags, options, credentials):
         tags = [(u'/' if db.unixStyle else u'') + db.credentials.username]
     for tag in tags:
         fulltag = db.abs_tag_path(tag, inPref=True)
-        if options.namespace or options.ns:
-            if db.ns_exists(fulltag):
+        (tagExists, nsExists) = db.path_kind(fulltag)
+        if nsExists:
+            if options.namespace or options.ns:
                 if long_ or options.longer:
                     nsResult = db.full_perms(fulltag[1:] + u'/',
                                              options.longer, options.group)
@@ -610,15 +924,11 @@ def execute_ls_command(objs, tags, options, credentials):
                     nsResult = fulltag
                 Print(nsResult)
             else:
-                nsResult = u'Not Found'
-        else:
-            nsResult = db.list_sorted_ns(fulltag[1:], long_=long_,
-                                         recurse=options.recurse, prnt=True,
-                                         longer=options.longer)
-        tagExists = db.tag_exists(fulltag)
-        if nsResult == u'Error status 404':
-            if not tagExists:
-                Print(u'%s not found' % fulltag)
+                db.list_sorted_ns(fulltag[1:], long_=long_,
+                                  recurse=options.recurse, prnt=True,
+                                  longer=options.longer)
+        elif not tagExists:
+            Print(u'%s not found' % fulltag)
         if tagExists:
             if long_ or options.longer:
                 Print(db.full_perms(fulltag[1:], options.longer, options.group))
@@ -668,6 +978,8 @@ def execute_perms_command(objs, args, options, credentials):
     db = ExtendedFluidDB(host=options.hostname, credentials=credentials,
                          debug=options.debug,
                          unixStylePaths=fdblib.path_style(options))
+    if options.permscache:
+        db.permsCache = perms_cache(db.host)
     if len(args) < 2:
         Print(u'Form: perms SPEC list of tags and namespaces')
         return
@@ -680,34 +992,189 @@ def execute_perms_command(objs, args, options, credentials):
         if len(args) < 3:
             Print((u'Group form: perms %s list+of+group+members list of tags '
                    u'and namespaces' % spec))
+    else:
+        group = None
     fullpaths = (db.abs_tag_path(t, inPref=True) for t in args[1 + isGroup:])
+    items = []
     for path in fullpaths:
-        done = False
-        owner = path.split(u'/')[1]
-        for (exists, isTag) in ((db.tag_exists, True), (db.ns_exists, False)):
-            if exists(path):
-                inPerms = FluidinfoPerms(db, path, isTag=isTag, getFromFI=False)
-                if spec == u'private':
-                    inPerms.set_to_private()
-                elif spec == u'default':
-                    inPerms.set_to_default()
-                elif spec == u'lock':
-                    inPerms = FluidinfoPerms(db, path, isTag=isTag,
-                                             getFromFI=True)
-                    inPerms.lock()
-                elif spec == u'unlock':
-                    inPerms = FluidinfoPerms(db, path, isTag=isTag,
-                                             getFromFI=True)
-                    inPerms.unlock()
-                else:  # group
-                    inPerms = FluidinfoPerms(db, path, isTag=isTag,
-                                             getFromFI=True)
-                    if spec in (u'group', u'group-read'):
-                         inPerms.set_group_readable(group)
-                    if spec in (u'group', u'group-write'):
-                         inPerms.set_group_writable(group)
-                inPerms.update_fluidinfo(db)
-                done = True
-        if not done:
+        found = path_items(db, path, options.recurse)
+        if not found:
             Print('No tag or namespace %s found' % db.abs_tag_path(path,
                                                                 outPref=True))
+        items.extend(found)
+    nChanged = nUnchanged = 0
+    updated = []
+    for ((path, isTag), (changed, unchanged)) in zip(items,
+                            update_perms(db, items, spec, group, options)):
+        nChanged += len(changed)
+        nUnchanged += len(unchanged)
+        if changed:
+            updated.append(path[1:] + (u'' if isTag else u'/'))
+        if options.verbose and changed:
+            Print(u'%s: changed %s' % (path, u', '.join(changed)))
+    snapshot.invalidate(db.host, perms=updated)
+    Print(u'%d permission%s changed; %d unchanged.'
+          % (nChanged, u'' if nChanged == 1 else u's', nUnchanged))
+
+
+def execute_rm_command(objs, args, options, credentials):
+    db = ExtendedFluidDB(host=options.hostname, credentials=credentials,
+                         debug=options.debug,
+                         unixStylePaths=fdblib.path_style(options))
+    if len(args) == 0:
+        Print(u'Form: rm [-R] list of tags and namespaces')
+        return
+    verb = u'Would remove' if options.dryrun else u'Removed'
+    nDeleted = nFailed = 0
+    removed = []
+    for path in (db.abs_tag_path(t, inPref=True) for t in args):
+        (isTag, isNs) = db.path_kind(path)
+        if not (isTag or isNs):
+            Print(u'No tag or namespace %s found' % path)
+            continue
+        if isNs and options.recurse:
+            r = db.rm_r(path[1:], dryRun=options.dryrun,
+                        progress=sys.stderr.isatty())
+            if type(r) == types.IntType:
+                Print(u'Could not list %s: %s' % (path, cli.error_code(r)))
+                nFailed += 1
+                continue
+            (deleted, failed) = r
+        else:
+            deleted = []
+            failed = []
+            for (t, exists) in ((True, isTag), (False, isNs)):
+                if not exists:
+                    continue
+                status = (fdblib.STATUS.NO_CONTENT if options.dryrun
+                          else db.delete_item(path, t))
+                if status == fdblib.STATUS.NO_CONTENT:
+                    deleted.append((path, t))
+                else:
+                    failed.append((path, t, status))
+        for (p, t, status) in failed:
+            Print(u'Failed to remove %s %s: %s'
+                  % (u'tag' if t else u'namespace', p, cli.error_code(status)))
+        if options.verbose or options.dryrun:
+            for (p, t) in deleted:
+                Print(u'%s %s %s' % (verb, u'tag' if t else u'namespace', p))
+        nDeleted += len(deleted)
+        nFailed += len(failed)
+        if deleted and not options.dryrun:
+            removed.append(path[1:])
+    snapshot.invalidate(db.host, removed=removed)
+    Print(u'%d item%s %s; %d failed.'
+          % (nDeleted, u'' if nDeleted == 1 else u's',
+             u'would be removed' if options.dryrun else u'removed', nFailed))
+
+
+def execute_snapshot_command(objs, args, options, credentials):
+    db = ExtendedFluidDB(host=options.hostname, credentials=credentials,
+                         debug=options.debug,
+                         unixStylePaths=fdblib.path_style(options))
+    snap = snapshot.Snapshot(db.host, snapshot.snapshot_file(db.host))
+    snap.load()
+    if len(args) == 0:
+        args = [(u'/' if db.unixStyle else u'') + db.credentials.username]
+    for path in args:
+        root = db.abs_tag_path(path, inPref=True)[1:]
+        r = snap.refresh(db, root, perms=options.snapshotperms,
+                         fresh=options.fresh)
+        if type(r) == types.IntType:
+            Print(u'/%s: %s' % (root, u'not found' if r == 404
+                                else u'error status %d' % r))
+            continue
+        (n, nChanged, failures) = r
+        Print(u'/%s: %d namespace%s (%d new or changed)%s'
+              % (root, n, u'' if n == 1 else u's', nChanged,
+                 u'; %d could not be read' % failures if failures else u''))
+    snap.save()
+
+
+def subtree_items(db, path):
+    """Returns (path, isTag) for the namespace path and every tag and
+       namespace below it, from a walk of the tree (see walk_namespaces),
+       or [] if path isn't a namespace."""
+    items = []
+    for (ns, tags, spaces) in db.walk_namespaces(path[1:]):
+        if type(tags) == types.IntType:
+            if ns == path[1:]:
+                return []
+            cli.warning(u'Could not list /%s: %s' % (ns, cli.error_code(tags)))
+        else:
+            items.append((u'/' + ns, False))
+            items.extend((u'/%s/%s' % (ns, tag), True) for tag in tags)
+    return items
+
+
+def path_items(db, path, recurse=False):
+    """Returns (path, isTag) for the tag and/or namespace at path,
+       and, if recurse is True, every tag and namespace below it
+       (see subtree_items)."""
+    (isTag, isNs) = db.path_kind(path)
+    items = [(path, True)] if isTag else []
+    if isNs:
+        items.extend((subtree_items(db, path) if recurse else [])
+                     or [(path, False)])
+    return items
+
+
+def new_perms(db, path, isTag, spec, group=None, h=None):
+    """Returns the FluidinfoPerms that perms spec (private, default,
+       lock, unlock or a group spec) gives path.   The specs that modify
+       the existing permissions use h, if given, rather than reading them."""
+    if spec in (u'private', u'default'):
+        perms = FluidinfoPerms(db, path, isTag=isTag, getFromFI=False)
+        if spec == u'private':
+            perms.set_to_private()
+        else:
+            perms.set_to_default()
+        return perms
+    perms = FluidinfoPerms(db, path, isTag=isTag, getFromFI=True, hash=h)
+    if spec == u'lock':
+        perms.lock()
+    elif spec == u'unlock':
+        perms.unlock()
+    else:  # group
+        if spec in (u'group', u'group-read'):
+            perms.set_group_readable(group)
+        if spec in (u'group', u'group-write'):
+            perms.set_group_writable(group)
+    return perms
+
+
+def update_perms(db, items, spec, group, options, jobs=PERM_JOBS):
+    """Applies perms spec to each (path, isTag) in items, working on
+       up to jobs items at once, and writing only what changes
+       (see FluidinfoPerms.update_fluidinfo).   Progress is reported
+       on stderr when there are many items and it's a terminal.
+
+       Each item's permissions are read once, afresh, and that is both
+       what the specs that modify the existing permissions start from
+       (working on a copy) and what the new permissions are compared with.
+
+       Returns: the (changed, unchanged) pair for each item, in order.
+    """
+    workers = fdblib.WorkerPool(jobs)
+    hashes = db.perms_hashes([path[1:] + (u'' if isTag else u'/')
+                              for (path, isTag) in items], jobs, fresh=True)
+
+    def update(perms, current):
+        return perms.update_fluidinfo(db, 1, current)
+
+    try:
+        pendings = [workers.submit(update,
+                                   new_perms(db, path, isTag, spec, group,
+                                             copy.deepcopy(h)), h)
+                    for ((path, isTag), (item, h)) in zip(items, hashes)]
+        progress = len(items) > 10 and sys.stderr.isatty()
+        results = []
+        for (i, p) in enumerate(pendings):
+            results.append(p.result())
+            if progress:
+                sys.stderr.write(u'\r%d of %d done' % (i + 1, len(items)))
+        if progress:
+            sys.stderr.write(u'\n')
+        return results
+    finally:
+        workers.close()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# nstree.py
+#
+# Copyright (c) Nicholas J. Radcliffe 2009-2011 and other authors specified
+#               in the AUTHOR
+# Licence terms in LICENCE.
+#
+# Walking namespace trees and reading the permissions on what's in them,
+# shared by ls and snapshot.
+
+import itertools
+import types
+import fdblib
+from collections import deque
+
+WALK_JOBS = 8           # namespaces listed at once when walking a tree
+WALK_LOOKAHEAD = 64     # ...and at most this many ahead of the caller
+PERM_JOBS = 8           # permissions fetched at once (see perms_hashes)
+PERM_LOOKAHEAD = 64     # items whose permissions are fetched ahead
+
+
+class PermissionDesc:
+    def __init__(self, entity, path, actions, names):
+        self.entity = entity
+        self.path = path
+        self.actions = actions
+        self.names = names
+
+    def action(self, name):
+        return self.actions[self.names.index(name)]
+
+
+RAW_PERMS = {
+    u'abstract-tag': PermissionDesc(u'abstract-tag', u'tags',
+                                    [u'update', u'delete', u'control'],
+                                    [u'metadata', u'delete', u'acontrol']),
+    u'tag': PermissionDesc(u'tag', u'tag-values',
+                           [u'create', u'read', u'delete', u'control'],
+                           [u'tag', u'read', u'untag', 'tcontrol']),
+    u'namespace': PermissionDesc(u'namespace', u'namespaces',
+                                 [u'create', u'update', u'delete', u'list',
+                                  u'control'],
+                                 [u'create', u'metadata', u'delete', u'read',
+                                  u'control'])
+}
+
+RAW_PERM_ENTITIES = RAW_PERMS.keys()
+
+
+def walk_namespaces(db, rootns, jobs=WALK_JOBS, depthFirst=False,
+                    lookahead=WALK_LOOKAHEAD, lister=None):
+    """
+    Walks the whole namespace tree below (and including) rootns,
+    listing up to jobs namespaces at once through db, and yields
+    (namespace, tagNames, namespaceNames) for each namespace:
+    its full path, and the (sorted) short names of its tags and
+    subnamespaces.   If a namespace can't be listed, tagNames is
+    the integer error status instead, and namespaceNames is empty.
+
+    Namespaces are yielded breadth-first (level by level), or in
+    depth-first pre-order (as ls -R lists them) if depthFirst is set.
+    Either way, the next lookahead namespaces to be yielded (as far
+    as they are known) are requested in advance, so there is
+    little waiting, but no more than that many listings are held
+    in memory however big the tree is.
+
+    lister(ns), if given, is used to list each namespace instead of
+    db.list_namespace (without the description); it must return what
+    list_namespace does.
+    """
+    workers = fdblib.WorkerPool(jobs)
+    if db.pool.maxSize < workers.jobs:
+        db.pool.maxSize = workers.jobs
+
+    def fetch(ns):
+        L = (lister(ns) if lister
+             else db.list_namespace(ns, returnDescription=False))
+        if type(L) == types.IntType:
+            return (ns, L, [])
+        return (ns, sorted(L[u'tagNames']), sorted(L[u'namespaceNames']))
+
+    todo = deque([[rootns, None]])      # [ns, Pending or None], in order
+    try:
+        while todo:
+            for entry in itertools.islice(todo, lookahead):
+                if entry[1] is None:
+                    entry[1] = workers.submit(fetch, entry[0])
+            (ns, tags, spaces) = todo.popleft()[1].result()
+            yield (ns, tags, spaces)
+            children = [[u'%s/%s' % (ns, space), None] for space in spaces]
+            if depthFirst:
+                todo.extendleft(reversed(children))
+            else:
+                todo.extend(children)
+    finally:
+        workers.close()
+
+
+def perms_hashes(db, items, jobs=PERM_JOBS, lookahead=PERM_LOOKAHEAD,
+                 fresh=False):
+    """
+    For each item in items (a tag, or a namespace with a trailing /,
+    as listed by ls), yields (item, h), in order, where h maps the
+    name of each of its permissions (read, metadata, ...) to the
+    FluidinfoPerm (or error status) from db.get_raw_perm.
+
+    The requests are made up to jobs at once, for up to lookahead
+    items ahead of the one being yielded, with any duplicates among
+    those made only once, and each item is yielded as soon as its
+    permissions (and those before it) have arrived.
+
+    If fresh is True, the permissions are read from Fluidinfo rather
+    than from any cache or snapshot db has (see get_raw_perm).
+    """
+    workers = fdblib.WorkerPool(jobs)
+    if db.pool.maxSize < workers.jobs:
+        db.pool.maxSize = workers.jobs
+    pendings = {}
+    plan = deque()
+
+    def request(item):
+        path = item.strip()
+        isTag = not path.endswith(u'/')
+        if not isTag:
+            path = path[:-1]
+        entities = [u'abstract-tag', u'tag'] if isTag else [u'namespace']
+        perms = []
+        for entity in entities:
+            desc = RAW_PERMS[entity]
+            for (action, name) in zip(desc.actions, desc.names):
+                key = (entity, path, action)
+                if not key in pendings:
+                    pendings[key] = workers.submit(db.get_raw_perm,
+                                                   entity, path, action,
+                                                   isTag, fresh)
+                perms.append((name, key, pendings[key]))
+        plan.append((item, perms))
+
+    def result():
+        (item, perms) = plan.popleft()
+        for (name, key, p) in perms:
+            pendings.pop(key, None)
+        return (item, dict((name, p.result()) for (name, key, p) in perms))
+
+    try:
+        for item in items:
+            request(item)
+            if len(plan) > lookahead:
+                yield result()
+        while plan:
+            yield result()
+    finally:
+        workers.close()
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+# snapshot.py
+#
+# Copyright (c) Nicholas J. Radcliffe 2009-2011 and other authors specified
+#               in the AUTHOR
+# Licence terms in LICENCE.
+#
+# Local snapshots of namespace trees (fdb snapshot), which ls reads
+# instead of Fluidinfo when they cover the paths listed (unless --fresh,
+# or the snapshot is older than --max-age).
+
+import gzip
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import time
+import types
+import fdblib
+import nstree
+
+if sys.version_info < (2, 6):
+    try:
+        import simplejson as json
+    except ImportError:
+        from django.utils import simplejson as json
+else:
+    import json
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_AGE = 3600.0       # seconds for which ls trusts a snapshot
+
+
+def snapshot_file(host):
+    """Returns the default snapshot file for host,
+       under the user's home directory."""
+    name = u'snapshot-%s.json.gz' % re.sub(ur'[^A-Za-z0-9.\-]+', u'_', host)
+    return os.path.join(fdblib.get_cache_dir(), name)
+
+
+def under(path, root):
+    return path == root or path.startswith(root + u'/')
+
+
+def listing_hash(description, tags, spaces):
+    return unicode(hashlib.sha1(json.dumps([description, tags, spaces]))
+                   .hexdigest())
+
+
+class Snapshot:
+    """
+    A local copy of one or more namespace trees on one host: for each
+    namespace, its description and the names of its tags and
+    subnamespaces, and, optionally, the permissions on every
+    tag and namespace.
+
+    The snapshot is kept as gzipped JSON.   Each namespace's entry
+    records a hash of its listing, and the validators (ETag and
+    Last-Modified) that came with it, so that refresh() only reads
+    the listings that have changed (see ExtendedFluidDB.list_namespace),
+    and only re-reads the permissions of items in those (and new items).
+    Permissions can change without any listing changing, so
+    refresh(..., fresh=True) re-reads them all.
+
+    ExtendedFluidDB reads listings and permissions from db.snapshot,
+    if set, for the namespaces it covers.   fdb rm, perms and tag drop
+    what they change from the saved snapshot (see invalidate).
+    """
+    def __init__(self, host, filename=None):
+        self.host = host
+        self.filename = filename
+        self.namespaces = {}    # ns -> {d: description, t: tags,
+                                #        n: subnamespaces, h: listing hash,
+                                #        v: validators}
+        self.perms = {}         # item -> {name: [policy, exceptions]}
+        self.taken = {}         # root -> time of last refresh
+
+    def load(self):
+        """Reads the snapshot from its file, returning False
+           if there isn't one (or it can't be read)."""
+        try:
+            f = gzip.open(self.filename, 'rb')
+            try:
+                h = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return False
+        if h.get(u'version') != SNAPSHOT_VERSION or h.get(u'host') != self.host:
+            return False
+        self.namespaces = h[u'namespaces']
+        self.perms = h[u'perms']
+        self.taken = h[u'taken']
+        return True
+
+    def save(self):
+        data = json.dumps({u'version': SNAPSHOT_VERSION, u'host': self.host,
+                           u'taken': self.taken,
+                           u'namespaces': self.namespaces,
+                           u'perms': self.perms}, separators=(',', ':'))
+        dir = os.path.dirname(self.filename)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd, tmp = tempfile.mkstemp(dir=dir)
+        os.close(fd)
+        f = gzip.open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+    def covers(self, ns):
+        return ns in self.namespaces
+
+    def listing(self, ns, returnDescription=True, returnNamespaces=True,
+                returnTags=True):
+        """Returns what list_namespace would for ns, according to the
+           snapshot, or None if the snapshot doesn't cover ns."""
+        entry = self.namespaces.get(ns)
+        if entry is None:
+            return None
+        L = {}
+        if returnDescription:
+            L[u'description'] = entry[u'd']
+        if returnNamespaces:
+            L[u'namespaceNames'] = entry[u'n'][:]
+        if returnTags:
+            L[u'tagNames'] = entry[u't'][:]
+        return L
+
+    def perm(self, entity, path, action):
+        """Returns the permission (a hash with policy and exceptions)
+           for action on the entity at path, or None if the snapshot
+           doesn't have it."""
+        if not entity in nstree.RAW_PERMS:
+            return None         # e.g. a policy
+        item = path if entity != u'namespace' else path + u'/'
+        perms = self.perms.get(item)
+        if perms is None:
+            return None
+        desc = nstree.RAW_PERMS[entity]
+        p = perms.get(desc.names[desc.actions.index(action)])
+        return (None if p is None
+                else {u'policy': p[0], u'exceptions': p[1]})
+
+    def items(self, root):
+        """Yields every namespace (with a trailing /) and tag under root."""
+        for ns in sorted(ns for ns in self.namespaces if under(ns, root)):
+            yield ns + u'/'
+            for tag in self.namespaces[ns][u't']:
+                yield u'%s/%s' % (ns, tag)
+
+    def expire(self, maxAge):
+        """Forgets the trees taken more than maxAge seconds ago (apart from
+           any parts of them also in newer ones), so that they are read
+           from Fluidinfo instead."""
+        now = time.time()
+        old = [root for root in self.taken if now - self.taken[root] > maxAge]
+        new = [root for root in self.taken if not root in old]
+
+        def stale(path):
+            return (any(under(path, root) for root in old)
+                    and not any(under(path, root) for root in new))
+
+        for ns in [ns for ns in self.namespaces if stale(ns)]:
+            del self.namespaces[ns]
+        for item in [item for item in self.perms if stale(item.rstrip(u'/'))]:
+            del self.perms[item]
+        for root in old:
+            del self.taken[root]
+
+    def forget(self, path):
+        """Forgets the tag or namespace at path, everything under it,
+           and the listing of the namespace that contains it, as after
+           it is removed.   Returns True if the snapshot had any of them."""
+        parent = path.rsplit(u'/', 1)[0]
+        spaces = [ns for ns in self.namespaces
+                  if under(ns, path) or (ns == parent and ns != path)]
+        items = [item for item in self.perms
+                 if under(item.rstrip(u'/'), path)]
+        for ns in spaces:
+            del self.namespaces[ns]
+        for item in items:
+            del self.perms[item]
+        return bool(spaces or items)
+
+    def forget_perms(self, items):
+        """Forgets the permissions of items (tags, and namespaces with
+           a trailing /), as after they are changed.   Returns True if
+           the snapshot had any of them."""
+        found = [item for item in items if item in self.perms]
+        for item in found:
+            del self.perms[item]
+        return bool(found)
+
+    def forget_unlisted(self, tags):
+        """Forgets the listing of any namespace that doesn't show the
+           tags given (or the namespaces they are in) as being in it,
+           as after they are created.   Returns True if there were any."""
+        stale = set()
+        for tag in tags:
+            parts = tag.split(u'/')
+            for i in range(1, len(parts)):
+                ns = u'/'.join(parts[:i])
+                entry = self.namespaces.get(ns)
+                if entry is not None and not parts[i] in entry[
+                        u't' if i == len(parts) - 1 else u'n']:
+                    stale.add(ns)
+        for ns in stale:
+            del self.namespaces[ns]
+        return bool(stale)
+
+    def refresh(self, db, root, perms=False, fresh=False):
+        """
+        Replaces the snapshot's copy of the tree under root with the
+        one on Fluidinfo now, read through db (an ExtendedFluidDB).
+        Each namespace's listing is only read if it has changed;
+        the rest are confirmed (with a 304 Not Modified) and kept.
+
+        If perms is True, the permissions on every item are recorded:
+        those of items that are new, or in namespaces whose listings
+        have changed, are read, and the rest kept, unless fresh is True.
+
+        Returns: the number of namespaces read, the number of those that
+        had changed, and the number of namespaces that couldn't be read,
+        or an error status if root can't be listed.
+        """
+        descriptions = {}
+        validators = {}
+
+        def lister(ns):
+            old = self.namespaces.get(ns)
+            v = dict(old.get(u'v', {})) if old else {}
+            L = db.list_namespace(ns, validators=v)
+            if L == fdblib.STATUS.NOT_MODIFIED:
+                L = self.listing(ns)
+            if type(L) != types.IntType:
+                descriptions[ns] = L.get(u'description', u'')
+                validators[ns] = v
+            return L
+
+        namespaces = {}
+        changed = set()
+        failures = 0
+        for (ns, tags, spaces) in nstree.walk_namespaces(db, root,
+                                                         lister=lister):
+            if type(tags) == types.IntType:
+                if ns == root:
+                    return tags
+                failures += 1
+                continue
+            h = listing_hash(descriptions[ns], tags, spaces)
+            namespaces[ns] = {u'd': descriptions[ns], u't': tags,
+                              u'n': spaces, u'h': h, u'v': validators[ns]}
+            old = self.namespaces.get(ns)
+            if old is None or old[u'h'] != h:
+                changed.add(ns)
+
+        for ns in [ns for ns in self.namespaces if under(ns, root)]:
+            del self.namespaces[ns]
+        self.namespaces.update(namespaces)
+        current = set(self.items(root))
+        for item in [item for item in self.perms if under(item, root)
+                     and not item in current]:
+            del self.perms[item]
+        if perms:
+            stale = [item for item in self.items(root)
+                     if fresh or not item in self.perms
+                        or item.rsplit(u'/', 1)[0] in changed]
+            for (item, h) in nstree.perms_hashes(db, stale):
+                if all(type(p) != types.IntType for p in h.values()):
+                    self.perms[item] = dict((name, [p.policy, p.exceptions])
+                                            for (name, p) in h.items())
+                else:
+                    self.perms.pop(item, None)
+        self.taken[root] = time.time()
+        return (len(namespaces), len(changed), failures)
+
+
+def load_snapshot(host, filename=None, maxAge=None):
+    """Returns the snapshot saved for host, or None if there isn't one.
+       If maxAge is given, trees taken longer ago than that (in seconds)
+       are left out (see Snapshot.expire)."""
+    snap = Snapshot(host, filename or snapshot_file(host))
+    if not snap.load():
+        return None
+    if maxAge is not None:
+        snap.expire(maxAge)
+    return snap
+
+
+def invalidate(host, removed=(), created=(), perms=(), filename=None):
+    """Brings the snapshot saved for host, if there is one, up to date
+       with changes just made, by forgetting the paths removed, the
+       listings that don't show the tags created, and the permissions
+       of the items whose permissions were changed (see Snapshot.forget,
+       forget_unlisted and forget_perms), so that ls reads those from
+       Fluidinfo instead of trusting the snapshot."""
+    if not (removed or created or perms):
+        return
+    snap = Snapshot(host, filename or snapshot_file(host))
+    if not snap.load():
+        return
+    changed = [snap.forget(path) for path in removed]
+    changed.append(snap.forget_unlisted(created))
+    changed.append(snap.forget_perms(perms))
+    if any(changed):
+        snap.save()
@@ -6,7 +6,14 @@
 #               in the AUTHOR
 # Licence terms in LICENCE.
 #
+import BaseHTTPServer
+import socket
+import threading
 import unittest
+import fdblib
+import ls
+import snapshot
+import audit
 from fdblib import *
 from cli import *
 
@@ -195,6 +202,48 @@ class TestFDBUtilityFunctions(unittest.TestCase):
         self.db.set_debug_timeout(5.0)
         self.dadgadID = id('DADGAD', self.db.host)
 
+    def testURLEncodeHash(self):
+        tags = [u'njr/caf\xe9', 'njr/rating']
+        self.assertEqual(urlencode_hash_u_8({u'tag': tags}),
+                         'tag=njr%2Fcaf%C3%A9&tag=njr%2Frating')
+        self.assertEqual(urlencode_hash_u_8({u'query': u'has njr/caf\xe9'}),
+                         'query=has+njr%2Fcaf%C3%A9')
+
+        def bulk(query):
+            if query == u'has njr/broken':
+                raise UnicodeEncodeError('ascii', u'', 0, 1, 'test')
+            return STATUS.NO_CONTENT
+
+        options = O()
+        options.valuesapi = True
+        objs = [O(), O(), O()]
+        objs[0].query = u'has njr/broken'
+        objs[1].query = u'has njr/caf\xe9'
+        saveout = sys.stdout
+        sys.stdout = SaveOut()
+        try:
+            done = bulk_by_query(objs, bulk, options)
+        finally:
+            sys.stdout = saveout
+        self.assertEqual(done, set([u'has njr/caf\xe9']))
+
+    def testGetRawValues(self):
+        calls = []
+
+        class ValuesDB(FluidDB):
+            def call(self, method, path, body=None, hash=None, **kw):
+                calls.append(hash[u'tag'])
+                return STATUS.OK, {u'results': {u'id': {
+                    u'id1': dict((t, {u'value': 1}) for t in hash[u'tag'])}}}
+
+        db = ValuesDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        tags = [u'njr/t%d' % i for i in range(VALUES_TAGS * 2 + 1)]
+        (status, H) = get_raw_values(db, u'has njr/t0', tags)
+        self.assertEqual(status, STATUS.OK)
+        self.assertEqual(sorted(H[u'id1'].keys()), sorted(tags))
+        self.assertEqual([len(c) for c in calls],
+                         [VALUES_TAGS, VALUES_TAGS, 1])
+
     def testFullTagPath(self):
         db = self.db
         user = db.credentials.username
@@ -289,6 +338,877 @@ class TestFDBUtilityFunctions(unittest.TestCase):
             self.assertEqual((s, v), (s, target))
             self.assertEqual((s, type(v)), (s, targetType))
 
+    def testConnectionPool(self):
+        pool = ConnectionPool(maxSize=1, idleTimeout=60)
+        url = u'http://fluiddb.fluidinfo.com/objects'
+        http, reused = pool.acquire(url, 5.0)
+        self.assertEqual(reused, False)
+        pool.release(url, 5.0, http)
+        self.assertEqual(pool.size(url, 5.0), 1)
+        http2, reused = pool.acquire(u'http://FluidDB.fluidinfo.com/tags',
+                                     5.0)
+        self.assertEqual((http2 is http, reused), (True, True))
+        pool.release(url, 5.0, http2)
+        pool.release(url, 5.0, Http())              # beyond maxSize
+        self.assertEqual(pool.size(url, 5.0), 1)
+        self.assertEqual(pool.size(u'http://sandbox.fluidinfo.com', 5.0), 0)
+
+        pool.idleTimeout = -1                      # everything is stale
+        http3, reused = pool.acquire(url, 5.0)
+        self.assertEqual((http3 is http, reused), (False, False))
+        self.assertEqual(pool.size(), 0)
+
+    def testWorkerPool(self):
+        def slow_square(n):
+            time.sleep(0.01 * (5 - n))      # finish out of order
+            if n == 3:
+                raise ValueError(n)
+            return n * n
+
+        for jobs in (1, 4):
+            workers = WorkerPool(jobs)
+            pendings = workers.submit_all(slow_square, range(5))
+            self.assertEqual([p.error() is None for p in pendings],
+                             [True, True, True, False, True])
+            self.assertEqual([p.result() for p in pendings if not p.error()],
+                             [0, 1, 4, 16])
+            self.assertRaises(ValueError, workers.map, slow_square, range(5))
+            self.assertEqual(workers.map(slow_square, (4, 0)), [16, 0])
+            workers.close()
+
+    def testAsyncUntag(self):
+        import asyncfdb
+
+        class MissingDB(FluidDB):
+            def call(self, method, path, body=None, hash=None, **kw):
+                return STATUS.NOT_FOUND, None
+
+        db = MissingDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        adb = asyncfdb.AsyncFluidDB(db, concurrency=2)
+        try:
+            self.assertEqual(adb.wait([
+                adb.untag_object_by_id(self.dadgadID, u'rating'),
+                adb.untag_object_by_id(self.dadgadID, u'rating', False),
+                adb.untag_object_by_about(u'DADGAD', u'rating'),
+                adb.untag_object_by_about(u'DADGAD', u'rating', False)]),
+                [0, STATUS.NOT_FOUND, 0, STATUS.NOT_FOUND])
+        finally:
+            adb.close()
+
+    def testAsyncConcurrency(self):
+        import asyncfdb
+        lock = threading.Lock()
+        inFlight = [0, 0]       # now, most at once
+
+        class SlowDB(FluidDB):
+            def call(self, method, path, body=None, hash=None, **kw):
+                with lock:
+                    inFlight[0] += 1
+                    inFlight[1] = max(inFlight)
+                try:
+                    n = int(path.split(u'/')[-1])
+                    time.sleep(0.01 * (8 - n))  # later ones finish first
+                    if n == 5:
+                        raise ValueError(path)
+                    return STATUS.OK, path
+                finally:
+                    with lock:
+                        inFlight[0] -= 1
+
+        db = SlowDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        adb = asyncfdb.AsyncFluidDB(db, concurrency=4)
+        try:
+            pendings = [adb.call(u'GET', u'/objects/%d' % i) for i in range(8)]
+            self.assertRaises(ValueError, adb.wait, pendings)
+            self.assertRaises(ValueError, pendings[5].result)
+            self.assertEqual([p.result()[1] for p in pendings
+                              if p.error() is None],
+                             [u'/objects/%d' % i for i in range(8) if i != 5])
+        finally:
+            adb.close()
+        self.assertEqual(inFlight, [0, 4])
+
+    def testTagCommandCreatesTags(self):
+        ensured = []
+        requests = []
+
+        class TagDB(FluidDB):
+            def ensure_tags_exist(self, tags, inPref=False, jobs=1):
+                ensured.append(tags)
+                return {}
+
+            def call(self, method, path, body=None, hash=None, **kw):
+                requests.append((method, path))
+                return STATUS.NO_CONTENT, None
+
+            def _set_tag_value(self, path, value, value_type=None):
+                requests.append((u'PUT', path))
+                return STATUS.NO_CONTENT, None
+
+        db = TagDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        options = O({'verbose': False, 'valuesapi': True, 'jobs': 1,
+                     'adaptive': False})
+        one = O({'mode': u'id', 'specifier': self.dadgadID})
+        execute_tag_command([one], db, [u'rating=5'], options)
+        self.assertEqual((ensured, len(requests)), ([], 1))
+        byQuery = O({'mode': u'id', 'specifier': self.dadgadID,
+                     'query': u'has njr/rating'})
+        execute_tag_command([byQuery], db, [u'rating=5'], options)
+        self.assertEqual(ensured, [[u'rating']])
+        self.assertEqual(requests[1], (u'PUT', u'/values'))
+
+    def testAboutIDCache(self):
+        filename = os.path.join(tempfile.mkdtemp(), u'ids.json')
+        cache = AboutIDCache(u'http://localhost', filename, size=2)
+        cache.put(u'DADGAD', self.dadgadID)
+        cache.put(u'αβγδε', u'1')
+        cache.get(u'DADGAD')
+        cache.put(u'ζηθικ', u'2')         # evicts αβγδε, least recently used
+        self.assertEqual((cache.get(u'DADGAD'), cache.get(u'αβγδε')),
+                         (self.dadgadID, None))
+        cache.save()
+
+        one = AboutIDCache(u'http://localhost', filename, size=4)
+        two = AboutIDCache(u'http://localhost', filename, size=4)
+        one.put(u'φχψω', u'3')
+        two.put(u'λμνξο', u'4')
+        one.save()
+        two.save()                        # merges with what one saved
+        reloaded = AboutIDCache(u'http://localhost', filename, size=4)
+        self.assertEqual([reloaded.get(a) for a in (u'ζηθικ', u'φχψω',
+                                                     u'λμνξο', u'DADGAD')],
+                         [u'2', u'3', u'4', self.dadgadID])
+        self.assertEqual(about_query([u'a"b', u'c']),
+                         u'fluiddb/about = "a\\"b" or fluiddb/about = "c"')
+
+    def testTagValueCache(self):
+        host = u'http://localhost'
+        cache = TagValueCache(ttl=60, maxEntries=3, maxBytes=10)
+        for (i, n) in enumerate((2, 3, 4, 5)):
+            cache.put((host, u'id%d' % i, u'/njr/rating'), (200, i), n)
+        # 4 entries and 10 bytes was too many: the first two have gone
+        self.assertEqual([cache.get((host, u'id%d' % i, u'/njr/rating'))
+                          for i in range(4)],
+                         [None, None, (200, 2), (200, 3)])
+        cache.put((host, u'id0', u'/njr/other'), (404, None))
+        cache.invalidate_tag(host, u'/njr/rating')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get((host, u'id0', u'/njr/other')),
+                         (404, None))
+        cache.ttl = -1
+        cache.put((host, u'id0', u'/njr/other'), (404, None))
+        self.assertEqual(cache.get((host, u'id0', u'/njr/other')), None)
+
+        db = FluidDB(Credentials(u'njr', u'secret'), host=host)
+        db.valueCache = cache
+        cache.ttl = 60
+        ids = AboutIDCache(host)            # in memory, so never saved
+        ids.put(u'DADGAD', self.dadgadID)
+        saved = fdblib._about_id_caches.get(host)
+        fdblib._about_id_caches[host] = ids
+        try:
+            key = db._value_cache_key(u'DADGAD', True, u'rating')
+            self.assertEqual(key, (host, self.dadgadID, u'/njr/rating'))
+            cache.put(key, (200, 10))
+            db._forget_tag_value(self.dadgadID, False, u'/njr/rating')
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(db._value_cache_key(u'unknown', True,
+                                                 u'rating'), None)
+        finally:
+            if saved is None:
+                del fdblib._about_id_caches[host]
+            else:
+                fdblib._about_id_caches[host] = saved
+
+    def testValidatorStore(self):
+        store = ValidatorStore(maxEntries=2, maxBytes=10)
+        url = u'http://localhost/namespaces/njr'
+        self.assertEqual(store.conditional_headers(url), {})
+        store.put(url, {u'etag': u'"abc"'}, u'{}')
+        store.put(url + u'/a', {u'last-modified': u'Mon'}, u'1234')
+        store.put(url + u'/b', {}, u'no validators')
+        self.assertEqual(store.conditional_headers(url),
+                         {u'If-None-Match': u'"abc"'})
+        self.assertEqual(store.conditional_headers(url + u'/a'),
+                         {u'If-Modified-Since': u'Mon'})
+        self.assertEqual(store.get(url + u'/b'), None)
+        store.put(url + u'/c', {u'etag': u'"c"'}, u'12345')
+        # 12 bytes was too many: the least recently used has gone
+        self.assertEqual(store.get(url), None)
+        self.assertEqual(store.get(url + u'/c'), ({u'etag': u'"c"'},
+                                                  u'12345'))
+        store.invalidate(url + u'/c')
+        self.assertEqual(store.nBytes, 4)
+
+    def testConditionalGet(self):
+        etag = '"v1"'
+        body = '{"tagNames": ["rating"], "namespaceNames": []}'
+        sent = []
+        evict = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == etag:
+                    sent.append(304)
+                    for f in evict:     # as another thread might
+                        f()
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                sent.append(200)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', len(body))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            db = ls.ExtendedFluidDB(Credentials(u'njr', u'secret'),
+                                    host=u'http://127.0.0.1:%d'
+                                         % server.server_port)
+            first = db.list_namespace(u'njr')
+            second = db.list_namespace(u'njr')
+            evict.append(db.validators.clear)
+            third = db.list_namespace(u'njr')
+            url = u'%s/namespaces/njr' % db.host
+            (response, content) = db._request(url, u'GET', None,
+                                              {u'If-None-Match': etag},
+                                              conditional=True)
+        finally:
+            server.shutdown()
+        self.assertEqual(sent, [200, 304, 304, 304, 200])
+        self.assertEqual(second, first)
+        self.assertEqual(third, first)
+        self.assertEqual(first[u'tagNames'], [u'rating'])
+        self.assertEqual(db.metrics[u'not_modified'], 2)
+        self.assertEqual((response.status, content), (200, body))
+
+    def testRetryPolicy(self):
+        policy = RetryPolicy(attempts=3, base=1, cap=3, jitter=False)
+        self.assertEqual(policy.retryable(u'GET', 1, 503), True)
+        self.assertEqual(policy.retryable(u'PUT', 2, 500), True)
+        self.assertEqual(policy.retryable(u'PUT', 3, 500), False)
+        self.assertEqual(policy.retryable(u'GET', 1, 404), False)
+        self.assertEqual(policy.retryable(u'POST', 1, 503), False)
+        self.assertEqual(policy.retryable(u'POST', 1, 503, idempotent=True),
+                         True)
+        self.assertEqual(policy.retryable(u'DELETE', 1,
+                                          error=socket.timeout()), True)
+        self.assertEqual(policy.retryable(u'DELETE', 1,
+                                          error=ValueError()), False)
+        self.assertEqual([policy.delay(n) for n in (1, 2, 3)], [1, 2, 3])
+        self.assertEqual(policy.delay(1, retryAfter=u'2'), 2)
+        self.assertEqual(policy.delay(1, retryAfter=u'120'), 3)
+        policy.jitter = True
+        self.assertTrue(0 <= policy.delay(2) <= 2)
+
+    def testRateLimiter(self):
+        limiter = RateLimiter(rate=100, burst=2)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertTrue(0 < limiter.acquire() <= 0.01)
+        set_rate_limit(u'localhost:8080', 5)
+        self.assertEqual(rate_limiter(u'http://LOCALHOST:8080').rate, 5)
+        set_rate_limit(u'http://localhost:8080', None)
+        self.assertEqual(rate_limiter(u'localhost:8080'), None)
+
+    def testConcurrencyController(self):
+        controller = ConcurrencyController(maximum=4, minimum=1, initial=2)
+        started = controller.acquire()
+        controller.release(started, True)
+        self.assertTrue(2 < controller.limit < 3)
+        controller.release(controller.acquire(), False)
+        self.assertEqual(controller.limit, 1.25)
+        for i in range(20):
+            controller.release(controller.acquire(), True)
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.inFlight, 0)
+
+        # Varying latency on its own doesn't cut concurrency,
+        # and failures don't cut it below half the jobs asked for
+        controller = ConcurrencyController(maximum=8)
+        for latency in [0.001, 0.5, 0.02, 1.0] * 5:
+            controller.acquire()
+            controller.release(time.time() - latency, True)
+        self.assertEqual(controller.limit, 8)
+        for i in range(5):
+            controller.acquire()
+            controller.lastDecrease = 0.0
+            controller.release(time.time(), False)
+        self.assertEqual(controller.limit, 4)
+
+        controller = ConcurrencyController(maximum=8, tolerance=3.0)
+        controller.release(controller.acquire(), True)
+        controller.acquire()
+        controller.release(time.time() - 1.0, True)
+        self.assertEqual(controller.limit, 4)
+
+    def testWalkNamespaces(self):
+        tree = {u'njr': ([u'rating'], [u'a', u'b']),
+                u'njr/a': ([], [u'deep']),
+                u'njr/a/deep': ([u'x'], []),
+                u'njr/b': ([u'y'], [])}
+
+        class TreeDB(ls.ExtendedFluidDB):
+            def list_namespace(self, ns, returnDescription=True):
+                if ns == u'njr/b':
+                    return STATUS.UNAUTHORIZED
+                return {u'tagNames': tree[ns][0],
+                        u'namespaceNames': tree[ns][1]}
+
+        db = TreeDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        self.assertEqual([ns for (ns, t, s) in db.walk_namespaces(u'njr')],
+                         [u'njr', u'njr/a', u'njr/b', u'njr/a/deep'])
+        self.assertEqual(list(db.walk_namespaces(u'njr', jobs=1,
+                                                 depthFirst=True)),
+                         [(u'njr', [u'rating'], [u'a', u'b']),
+                          (u'njr/a', [], [u'deep']),
+                          (u'njr/a/deep', [u'x'], []),
+                          (u'njr/b', STATUS.UNAUTHORIZED, [])])
+        self.assertEqual(list(db.walk_namespaces(u'njr', lookahead=1)),
+                         list(db.walk_namespaces(u'njr')))
+        self.assertEqual(db.list_r_namespace(u'njr'),
+                         {u'namespaceNames': [u'njr/a', u'njr/b',
+                                              u'njr/a/deep'],
+                          u'tagNames': [u'njr/rating', u'njr/a/deep/x'],
+                          u'failures': True})
+
+    def testRmR(self):
+        tree = {u'njr': ([u'rating'], [u'a', u'b']),
+                u'njr/a': ([u'locked'], [u'deep']),
+                u'njr/a/deep': ([u'x'], []),
+                u'njr/b': ([u'y'], [])}
+        deleted = []
+
+        class TreeDB(ls.ExtendedFluidDB):
+            def list_namespace(self, ns, returnDescription=True):
+                if not ns in tree:
+                    return STATUS.NOT_FOUND
+                return {u'tagNames': tree[ns][0],
+                        u'namespaceNames': tree[ns][1]}
+
+            def delete_abstract_tag(self, tag):
+                (ns, name) = tag[1:].rsplit(u'/', 1)
+                if name == u'locked':
+                    return STATUS.UNAUTHORIZED
+                tree[ns][0].remove(name)
+                deleted.append(tag)
+                return 0
+
+            def delete_namespace(self, path):
+                assert tree[path[1:]] == ([], [])
+                del tree[path[1:]]
+                if path != u'/njr':
+                    (parent, name) = path[1:].rsplit(u'/', 1)
+                    tree[parent][1].remove(name)
+                deleted.append(path)
+                return STATUS.NO_CONTENT
+
+        db = TreeDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        self.assertEqual(db.rm_r(u'njr/c'), STATUS.NOT_FOUND)
+        (d, failed) = db.rm_r(u'njr/a', dryRun=True)
+        self.assertEqual((d, failed, deleted),
+                         ([(u'/njr/a/locked', True), (u'/njr/a/deep/x', True),
+                           (u'/njr/a/deep', False), (u'/njr/a', False)],
+                          [], []))
+        (d, failed) = db.rm_r(u'njr', jobs=1)
+        self.assertEqual(deleted, [u'/njr/rating', u'/njr/b/y',
+                                   u'/njr/a/deep/x', u'/njr/a/deep', u'/njr/b'])
+        self.assertEqual(failed, [(u'/njr/a/locked', True, STATUS.UNAUTHORIZED),
+                                  (u'/njr/a', False,
+                                   STATUS.PRECONDITION_FAILED),
+                                  (u'/njr', False,
+                                   STATUS.PRECONDITION_FAILED)])
+        tree[u'njr/a'][0].remove(u'locked')
+        self.assertEqual(db.rm_r(u'njr'),
+                         ([(u'/njr/a', False), (u'/njr', False)], []))
+        self.assertEqual(tree, {})
+
+    def testPermsHashes(self):
+        calls = []
+
+        class PermsDB(ls.ExtendedFluidDB):
+            def get_raw_perm(self, entity, name, action, isTag, fresh=False):
+                calls.append((entity, name, action))
+                return ls.FluidinfoPerm(u'njr', u'closed', [u'njr'],
+                                        name=name, action=action, isTag=isTag)
+
+        db = PermsDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        items = [u'njr/rating ', u'njr/a/', u'njr/rating']
+        hashes = list(db.perms_hashes(items))
+        self.assertEqual([item for (item, h) in hashes], items)
+        self.assertEqual(sorted(hashes[0][1].keys()),
+                         [u'acontrol', u'delete', u'metadata', u'read',
+                          u'tag', u'tcontrol', u'untag'])
+        self.assertEqual(hashes[1][1][u'read'].action, u'list')
+        self.assertEqual(len(calls), 7 + 5)     # the repeat is not refetched
+        self.assertEqual(db.ns_perms_string(u'njr/a', h=hashes[1][1]),
+                         u'nrwc------')
+
+    def testPermsCache(self):
+        filename = os.path.join(tempfile.mkdtemp(), u'perms.json')
+        closed = {u'policy': u'closed', u'exceptions': [u'njr']}
+        opened = {u'policy': u'open', u'exceptions': []}
+        one = ls.PermsCache(filename)
+        two = ls.PermsCache(filename)
+        one.put((u'tag', u'njr/rating', u'read'), opened)
+        one.put((u'tag', u'njr/rating', u'create'), closed)
+        one.save()
+        two.put((u'namespace', u'njr', u'list'), opened)
+        two.save()                        # merges with what one saved
+        one.invalidate((u'tag', u'njr/rating', u'create'))
+        one.save()
+        reloaded = ls.PermsCache(filename)
+        self.assertEqual(len(reloaded), 2)
+        self.assertEqual(reloaded.get((u'namespace', u'njr', u'list')),
+                         opened)
+        self.assertEqual(reloaded.get((u'tag', u'njr/rating', u'create')),
+                         None)
+        expired = ls.PermsCache(ttl=-1)
+        expired.put((u'tag', u'njr/rating', u'read'), opened)
+        self.assertEqual(expired.get((u'tag', u'njr/rating', u'read')), None)
+
+    def testUpdatePerms(self):
+        server = {}
+        reads = []
+        writes = []
+
+        class PermsDB(ls.ExtendedFluidDB):
+            def call(self, method, path, body=None, hash=None, **kw):
+                key = (path, kw[u'action'])
+                if method == u'PUT':
+                    writes.append(key)
+                    server[key] = json.loads(body)
+                    return STATUS.NO_CONTENT, None
+                reads.append(key)
+                return STATUS.OK, dict(server[key])
+
+        db = PermsDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        perms = ls.FluidinfoPerms(db, u'/njr/rating', isTag=True,
+                                  getFromFI=False)
+        closed = {u'policy': u'closed', u'exceptions': [u'njr']}
+        for (entity, desc) in ls.RAW_PERMS.items():
+            for action in desc.actions:
+                server[(u'/permissions/%s/njr/rating' % desc.path,
+                        action)] = dict(closed)
+        read = (u'/permissions/tag-values/njr/rating', u'read')
+
+        (changed, unchanged) = perms.update_fluidinfo(db)
+        self.assertEqual((changed, len(unchanged)), ([u'read'], 6))
+        self.assertEqual(writes, [read])
+        self.assertEqual(server[read],
+                         {u'policy': u'open', u'exceptions': []})
+
+        del writes[:]
+        self.assertEqual(perms.update_fluidinfo(db)[0], [])
+        self.assertEqual(writes, [])
+
+        server[read] = dict(closed)     # changed elsewhere; cache is stale
+        self.assertEqual(db.permsCache.get((u'tag', u'njr/rating', u'read')),
+                         {u'policy': u'open', u'exceptions': []})
+        self.assertEqual(perms.update_fluidinfo(db)[0], [u'read'])
+        self.assertEqual(writes, [read])
+
+        server[read] = dict(closed)
+        del reads[:]
+        current = list(db.perms_hashes([u'njr/rating'], fresh=True))[0][1]
+        self.assertEqual(len(reads), 7)
+        del reads[:]
+        del writes[:]
+        self.assertEqual(perms.update_fluidinfo(db, current=current)[0],
+                         [u'read'])
+        self.assertEqual((reads, writes), ([], [read]))
+
+    def testUpdatePermsRequests(self):
+        server = {}
+        requests = []
+        lock = threading.Lock()
+
+        class PermsDB(ls.ExtendedFluidDB):
+            def call(self, method, path, body=None, hash=None, **kw):
+                key = (path, kw[u'action'])
+                with lock:
+                    requests.append((method, key))
+                    if method == u'PUT':
+                        server[key] = json.loads(body)
+                        return STATUS.NO_CONTENT, None
+                    return STATUS.OK, dict(server.get(key,
+                                                      {u'policy': u'open',
+                                                       u'exceptions': []}))
+
+        db = PermsDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        items = [(u'/njr/tag%d' % i, True) for i in range(10)]
+        puts = []
+        for spec in (u'private', u'private', u'default', u'lock'):
+            del requests[:]
+            results = ls.update_perms(db, items, spec, None, None)
+            gets = [key for (method, key) in requests if method == u'GET']
+            self.assertEqual((len(gets), len(set(gets))), (70, 70))
+            puts.append(len(requests) - len(gets))
+            self.assertEqual(sum(len(changed) for (changed, unchanged)
+                                 in results), puts[-1])
+        self.assertEqual(puts[:2], [70, 0])
+        self.assertEqual(puts[2:], [10, 40])
+
+    def testRecursivePerms(self):
+        tree = {u'njr/both': ([u'x'], [u'sub']),
+                u'njr/both/sub': ([u'y'], [])}
+        server = {}
+
+        class TreeDB(ls.ExtendedFluidDB):
+            def list_namespace(self, ns, returnDescription=True):
+                if ns == u'njr':
+                    return {u'tagNames': [u'both'],
+                            u'namespaceNames': [u'both']}
+                return {u'tagNames': tree[ns][0],
+                        u'namespaceNames': tree[ns][1]}
+
+            def call(self, method, path, body=None, hash=None, **kw):
+                key = (path, kw[u'action'])
+                if method == u'PUT':
+                    server[key] = json.loads(body)
+                    return STATUS.NO_CONTENT, None
+                return STATUS.OK, server.get(key, {u'policy': u'open',
+                                                   u'exceptions': []})
+
+        db = TreeDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        self.assertEqual(ls.path_items(db, u'/njr/both'),
+                         [(u'/njr/both', True), (u'/njr/both', False)])
+        items = ls.path_items(db, u'/njr/both', recurse=True)
+        self.assertEqual(items, [(u'/njr/both', True), (u'/njr/both', False),
+                                 (u'/njr/both/x', True),
+                                 (u'/njr/both/sub', False),
+                                 (u'/njr/both/sub/y', True)])
+        results = ls.update_perms(db, items, u'private', None, None)
+        self.assertEqual([len(changed) for (changed, unchanged) in results],
+                         [7, 5, 7, 5, 7])
+        self.assertEqual(len(server), 31)
+        self.assertTrue(all(p == {u'policy': u'closed',
+                                  u'exceptions': [u'njr']}
+                            for p in server.values()))
+
+    def testPathKind(self):
+        listed = []
+
+        class ListingDB(ls.ExtendedFluidDB):
+            def list_namespace(self, ns, returnDescription=True):
+                listed.append(ns)
+                if ns == u'njr/both':
+                    return {u'tagNames': [u'x'], u'namespaceNames': []}
+                elif ns != u'njr':
+                    return STATUS.NOT_FOUND
+                return {u'tagNames': [u'rating', u'both'],
+                        u'namespaceNames': [u'both', u'ns']}
+
+        db = ListingDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        self.assertEqual([db.path_kind(p) for p in (u'/njr', u'/njr/rating',
+                                                    u'/njr/ns', u'/njr/both',
+                                                    u'/njr/none',
+                                                    u'/njr/none/x')],
+                         [(False, True), (True, False), (False, True),
+                          (True, True), (False, False), (False, False)])
+        self.assertEqual(listed, [u'njr', u'njr/none'])
+
+        del listed[:]
+        options = O({'hostname': u'http://localhost', 'debug': False,
+                     'permscache': False, 'fresh': True, 'maxage': None,
+                     'long': False, 'group': False, 'longer': False,
+                     'policy': False, 'namespace': False, 'ns': False,
+                     'recurse': False, 'unixstylepaths': True,
+                     'fluidinfostylepaths': False})
+        original = ls.ExtendedFluidDB
+        saveout = sys.stdout
+        ls.ExtendedFluidDB = ListingDB
+        sys.stdout = SaveOut()
+        try:
+            ls.execute_ls_command([], [u'/njr/both'], options,
+                                  Credentials(u'njr', u'secret'))
+            out = u''.join(sys.stdout.buffer)
+        finally:
+            sys.stdout = saveout
+            ls.ExtendedFluidDB = original
+        self.assertEqual(listed, [u'njr', u'njr/both'])
+        self.assertEqual(out.split(), [u'x', u'/njr/both'])
+
+    def testSnapshot(self):
+        tree = {u'njr': (u'root', [u'rating'], [u'a']),
+                u'njr/a': (u'', [u'x'], [])}
+        fetched = []
+        listed = []
+
+        class TreeDB(ls.ExtendedFluidDB):
+            def list_namespace(self, ns, returnDescription=True,
+                               validators=None):
+                (d, tags, spaces) = tree[ns]
+                etag = snapshot.listing_hash(d, tags, spaces)
+                if validators is not None:
+                    if validators.get(u'etag') == etag:
+                        return STATUS.NOT_MODIFIED
+                    validators[u'etag'] = etag
+                listed.append(ns)
+                return {u'description': d, u'tagNames': tags,
+                        u'namespaceNames': spaces}
+
+            def get_raw_perm(self, entity, name, action, isTag, fresh=False):
+                fetched.append(name)
+                return ls.FluidinfoPerm(u'njr', u'open', [], name=name,
+                                        action=action, isTag=isTag)
+
+        db = TreeDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        filename = os.path.join(tempfile.mkdtemp(), u'snapshot.json.gz')
+        snap = snapshot.Snapshot(db.host, filename)
+        self.assertEqual(snap.refresh(db, u'njr', perms=True), (2, 2, 0))
+        self.assertEqual(len(fetched), 5 + 7 + 5 + 7)
+        snap.save()
+
+        snap = snapshot.load_snapshot(db.host, filename)
+        self.assertEqual(snap.listing(u'njr/a'),
+                         {u'description': u'', u'tagNames': [u'x'],
+                          u'namespaceNames': []})
+        self.assertEqual(snap.listing(u'njr/b'), None)
+        self.assertEqual(snap.perm(u'tag', u'njr/a/x', u'read'),
+                         {u'policy': u'open', u'exceptions': []})
+        self.assertEqual(snap.perm(u'namespace', u'njr/a', u'list'),
+                         {u'policy': u'open', u'exceptions': []})
+
+        tree[u'njr/a'] = (u'', [u'x', u'y'], [])
+        del fetched[:]
+        del listed[:]
+        self.assertEqual(snap.refresh(db, u'njr', perms=True), (2, 1, 0))
+        self.assertEqual(listed, [u'njr/a'])    # njr was not modified
+        self.assertEqual(snap.listing(u'njr')[u'tagNames'], [u'rating'])
+        self.assertEqual(sorted(set(fetched)), [u'njr/a', u'njr/a/x',
+                                                u'njr/a/y'])
+        db.snapshot = snap
+        self.assertEqual(db.path_kind(u'/njr/a/y'), (True, False))
+
+        snap.save()
+        self.assertTrue(snapshot.load_snapshot(db.host, filename,
+                                               maxAge=60).covers(u'njr/a'))
+        snap.taken[u'njr'] -= 120
+        snap.save()
+        snap = snapshot.load_snapshot(db.host, filename, maxAge=60)
+        self.assertEqual((snap.covers(u'njr/a'), snap.perms), (False, {}))
+
+    def testSnapshotInvalidate(self):
+        filename = os.path.join(tempfile.mkdtemp(), u'snap.json.gz')
+        snap = snapshot.Snapshot(u'http://localhost', filename)
+        snap.namespaces = {
+            u'njr': {u'd': u'', u't': [u'rating'], u'n': [u'a', u'x']},
+            u'njr/a': {u'd': u'', u't': [u'y'], u'n': []},
+            u'njr/x': {u'd': u'', u't': [u'z'], u'n': []},
+        }
+        open_ = [u'open', []]
+        snap.perms = dict((item, {u'read': open_}) for item in
+                          (u'njr/', u'njr/a/y', u'njr/x/', u'njr/x/z'))
+        snap.taken = {u'njr': time.time()}
+        snap.save()
+
+        def load():
+            return snapshot.load_snapshot(u'http://localhost', filename)
+
+        snapshot.invalidate(u'http://localhost', created=[u'njr/a/y',
+                                                          u'njr/rating'],
+                            filename=filename)
+        self.assertEqual(sorted(load().namespaces), [u'njr', u'njr/a',
+                                                     u'njr/x'])
+        snapshot.invalidate(u'http://localhost', removed=[u'njr/x'],
+                            filename=filename)
+        snap = load()
+        self.assertEqual(sorted(snap.namespaces), [u'njr/a'])
+        self.assertEqual(sorted(snap.perms), [u'njr/', u'njr/a/y'])
+        snapshot.invalidate(u'http://localhost', created=[u'njr/a/b/t'],
+                            perms=[u'njr/a/y'], filename=filename)
+        snap = load()
+        self.assertEqual((snap.namespaces, sorted(snap.perms)),
+                         ({}, [u'njr/']))
+
+    def testAudit(self):
+        snap = snapshot.Snapshot(u'http://localhost')
+        snap.namespaces = {u'njr': {u'd': u'', u't': [u'rating', u'secret'],
+                                    u'n': []}}
+        closed = [u'closed', [u'njr']]
+        snap.perms = {
+            u'njr/': {u'create': [u'closed', [u'njr', u'bob']],
+                      u'read': [u'open', []], u'acontrol': closed},
+            u'njr/rating': {u'read': [u'open', [u'bob']], u'tag': closed,
+                            u'acontrol': closed, u'tcontrol': closed},
+        }
+        a = audit.PermsAudit(snap, u'njr')
+        self.assertEqual(a.items, [u'njr/', u'njr/rating'])
+        self.assertEqual(a.missing, [u'njr/secret'])
+        self.assertTrue(a.columns[u'acontrol'][0][1]
+                        is a.columns[u'acontrol'][1][1])
+        self.assertEqual(a.world_readable(), [u'njr/', u'njr/rating'])
+        self.assertEqual(a.world_writable(), [])
+        self.assertEqual(a.readable_by(u'bob'), [u'njr/'])
+        self.assertEqual(a.writable_by(u'bob'), [u'njr/'])
+        self.assertEqual(a.writable_by(u'njr'), [u'njr/', u'njr/rating'])
+        self.assertEqual(a.control_differs(), [])
+        snap.perms[u'njr/rating'][u'tcontrol'] = [u'open', []]
+        self.assertEqual(audit.PermsAudit(snap, u'njr').control_differs(),
+                         [u'njr/rating'])
+
+    def testDeliciousImportFailures(self):
+        import delicious2fluiddb as d2f
+        from StringIO import StringIO
+
+        class ImportDB(FluidDB):
+            def tag_object_by_id(self, id, tag, **kw):
+                if id == u'http://a.com/':
+                    raise socket.error('connection reset')
+                return 0
+
+        db = ImportDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        filename = os.path.join(tempfile.mkdtemp(), u'imp.manifest')
+        manifest = d2f.Manifest(filename)
+        urls = [u'http://%s.com/' % c for c in u'abc']
+        for url in urls:
+            manifest.record(d2f.UrlKey(url), url, [u'x'])
+        export = (u'<posts total="3">%s</posts>'
+                  % u''.join(u'<post href="%s" tag="x y"/>' % url
+                             for url in urls))
+        saveout = sys.stdout
+        sys.stdout = SaveOut()
+        try:
+            counts = d2f.Import(db, StringIO(export), manifest, jobs=3)
+            output = u''.join(sys.stdout.buffer)
+        finally:
+            sys.stdout = saveout
+        self.assertEqual((counts['changed'], counts['failed']), (2, 1))
+        self.assertTrue(u'failed, and will be tried again' in output)
+        self.assertTrue(output.rstrip().endswith(u'http://a.com/'))
+        manifest = d2f.Manifest(filename)
+        manifest.load()
+        self.assertEqual([manifest.get(d2f.UrlKey(url))[1] for url in urls],
+                         [[u'x'], [u'x', u'y'], [u'x', u'y']])
+
+    def testDeliciousUpdateMarker(self):
+        import delicious
+        requests = []
+        marker = ['2009-08-22T10:00:00Z']
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path.split('/')[-1])
+                if self.path.endswith('/update'):
+                    body = '<update time="%s"/>' % marker[0]
+                else:
+                    body = ('<posts total="1"><post href="http://a.com/" '
+                            'description="A" tag="home"/></posts>')
+                self.send_response(200)
+                self.send_header('Content-Length', len(body))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        tmp = tempfile.mkdtemp()
+        credentials = os.path.join(tmp, 'credentials.txt')
+        f = open(credentials, 'w')
+        f.write('njr\nsecret\n')
+        f.close()
+
+        class Params(delicious.Params):
+            pass
+        Params.credentials = credentials
+        Params.cache = os.path.join(tmp, 'delicious.xml')
+        Params.homepage = os.path.join(tmp, 'missing', 'index.html')
+        Params.addDatestampCopy = False
+        Params.verbose = False
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever).start()
+        base = 'http://127.0.0.1:%d/v1/posts/' % server.server_port
+        saved = (delicious.API_URL, delicious.UPDATE_URL, delicious.Params)
+        (delicious.API_URL, delicious.UPDATE_URL,
+         delicious.Params) = (base + 'all', base + 'update', Params)
+        try:
+            self.assertRaises(IOError,
+                              delicious.RefreshHomepageFromDelicious)
+            self.assertEqual(delicious.ReadUpdateMarker(Params), None)
+            Params.homepage = os.path.join(tmp, 'index.html')
+            runs = []
+            for when in (marker[0], marker[0], '2009-08-23T00:00:00Z'):
+                marker[0] = when
+                del requests[:]
+                delicious.RefreshHomepageFromDelicious()
+                runs.append(requests[:])
+        finally:
+            (delicious.API_URL, delicious.UPDATE_URL,
+             delicious.Params) = saved
+            server.shutdown()
+        self.assertEqual(runs, [['update', 'all'], ['update'],
+                                ['update', 'all']])
+        self.assertEqual(delicious.ReadUpdateMarker(Params),
+                         '2009-08-23T00:00:00Z')
+
+        class Dropped:
+            def __init__(self):
+                self.blocks = ['<posts total="2"><post href="http://b.com/"']
+
+            def read(self, size=-1):
+                if not self.blocks:
+                    raise IOError('connection reset')
+                return self.blocks.pop()
+
+        cache = open(Params.cache).read()
+        files = sorted(os.listdir(tmp))
+        self.assertRaises(IOError, delicious.CopyStreamBackupTimestamp,
+                          Dropped(), Params.cache, Params)
+        self.assertEqual(open(Params.cache).read(), cache)
+        self.assertEqual(sorted(os.listdir(tmp)), files)
+
+    def testDeliciousImportRemovals(self):
+        import delicious2fluiddb as d2f
+        from StringIO import StringIO
+        untagged = []
+
+        class ImportDB(FluidDB):
+            def ensure_tags_exist(self, tags, inPref=False, jobs=1):
+                return {}
+
+            def untag_object_by_id(self, id, tag, **kw):
+                untagged.append((id, tag))
+                return 0
+
+        db = ImportDB(Credentials(u'njr', u'secret'), host=u'http://localhost')
+        filename = os.path.join(tempfile.mkdtemp(), u'imp.manifest')
+        post = '<post href="http://a.com/" description="A" tag="%s"/>'
+        exports = ['',
+                   '<?xml version="1.0"?><result code="access denied"/>',
+                   '<posts total="3">%s' % post % u'x',
+                   '<posts total="5">%s</posts>' % post % u'x',
+                   '<posts total="1">%s</posts>' % post % u'x']
+        saveout = sys.stdout
+        sys.stdout = SaveOut()
+        try:
+            for export in exports:
+                manifest = d2f.Manifest(filename)
+                manifest.load()
+                for url in (u'http://a.com/', u'http://b.com/'):
+                    manifest.record(d2f.UrlKey(url), url, [u'x'])
+                try:
+                    d2f.Import(db, StringIO(export), manifest, jobs=1)
+                except SyntaxError:         # including ParseError
+                    manifest.close()
+                self.assertEqual(untagged, [])
+            manifest = d2f.Manifest(filename)
+            manifest.load()
+            d2f.Import(db, StringIO(exports[-1]), manifest, jobs=1,
+                       force=True)
+        finally:
+            sys.stdout = saveout
+        self.assertEqual(untagged, [(u'http://b.com/', u'x')])
+
 
 def specify_DADGAD(mode, host):
     if mode == 'about':